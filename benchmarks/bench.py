@@ -0,0 +1,407 @@
+"""This module benchmarks key generation, file encryption and the database.
+
+Run it from the repository root:
+
+    python -m benchmarks.bench --key-lengths 1024 2048 --sizes 64K 1M \
+        --output results.json --baseline baseline.json
+
+Every benchmark reports ops/s, MB/s where bytes are processed, and
+p50/p90/p99 latencies. Results are saved as JSON and, when a baseline
+is given, compared with it. The import-time budget of encdb is checked
+by tests/test_startup.py.
+
+Files are encrypted and decrypted the way encdb.py does it, with the
+workers, buffer_size and mmap settings of config.json given by
+--workers, --buffer-size and --mmap.
+
+Functions:
+    parse_size(text: str) -> int: Parse a size such as 64K, 1M or 2G.
+    measure(func, repeat: int) -> list[float]:
+        Time repeated calls of a function.
+    summarize(times: list[float], nbytes: int | None = None) -> dict:
+        Compute throughput and latency percentiles.
+    bench_keys(key_lengths, repeat: int) -> dict:
+        Benchmark key generation and block encryption.
+    bench_files(key_lengths, sizes, repeat: int, workdir: str,
+        config: dict) -> dict:
+        Benchmark block and hybrid file encryption/decryption.
+    bench_db(rows: int, repeat: int, workdir: str) -> dict:
+        Benchmark the db.dbconn helpers on a database of rows files.
+    bench_startup(repeat: int) -> dict:
+        Benchmark the interpreter startup with and without encdb.
+    compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+        List the benchmarks that got slower than the baseline.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import db.dbconn as db
+import encdb
+import scrypt.compress as compress
+import scrypt.rsa as rsa
+import scrypt.utils as utils
+
+UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_size(text: str) -> int:
+    """Parse a size such as 64K, 1M or 2G.
+
+    Arguments:
+        text: a number of bytes, optionally followed by K, M or G.
+
+    Returns:
+        The size in bytes.
+    """
+    text = text.strip().upper()
+    if text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+
+    return int(text)
+
+
+def measure(func, repeat: int) -> list[float]:
+    """Time repeated calls of a function.
+
+    Arguments:
+        func: the function to call, without arguments.
+        repeat: the number of calls.
+
+    Returns:
+        The duration of every call in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    return times
+
+
+def _percentile(values: list[float], q: float) -> float:
+    """Return the q-th percentile (0-100) of values, by nearest rank."""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(times: list[float], nbytes: int | None = None) -> dict:
+    """Compute throughput and latency percentiles.
+
+    Arguments:
+        times: the durations of the runs in seconds.
+        nbytes: the bytes processed by one run, if any.
+
+    Returns:
+        A dict with runs, ops_per_s, p50_ms, p90_ms, p99_ms
+        and, if nbytes is given, mb_per_s.
+    """
+    total = sum(times)
+    summary = {
+        "runs": len(times),
+        "ops_per_s": len(times) / total if total else float("inf"),
+        "p50_ms": _percentile(times, 50) * 1000,
+        "p90_ms": _percentile(times, 90) * 1000,
+        "p99_ms": _percentile(times, 99) * 1000,
+    }
+    if nbytes is not None:
+        summary["mb_per_s"] = nbytes * len(times) / total / (1 << 20)
+
+    return summary
+
+
+def bench_keys(key_lengths, repeat: int) -> dict:
+    """Benchmark key generation and block encryption.
+
+    Arguments:
+        key_lengths: the key lengths in bits.
+        repeat: the number of runs per benchmark.
+
+    Returns:
+        The summaries, by benchmark name.
+    """
+    results = {}
+    for key_len in key_lengths:
+        times = measure(lambda: rsa.key_gen(key_len), repeat)
+        results[f"key_gen/{key_len}"] = summarize(times)
+
+        public_key, _ = rsa.key_gen(key_len)
+        context = rsa.RSAKeyContext(public_key)
+        blocks = [b"x"] * 1000
+        times = measure(lambda: context.encrypt_blocks(blocks), repeat)
+        results[f"encrypt_blocks_1000/{key_len}"] = summarize(times)
+
+    return results
+
+
+def bench_files(
+    key_lengths, sizes, repeat: int, workdir: str, config: dict
+) -> dict:
+    """Benchmark block and hybrid file encryption/decryption.
+
+    Arguments:
+        key_lengths: the key lengths in bits.
+        sizes: the plaintext sizes in bytes.
+        repeat: the number of runs per benchmark.
+        workdir: a directory for the temporary files.
+        config: the workers, buffer_size and mmap settings, as in
+            config.json.
+
+    Returns:
+        The summaries, by benchmark name.
+    """
+    results = {}
+    plain = os.path.join(workdir, "plain")
+    encrypted = os.path.join(workdir, "encrypted")
+    decrypted = os.path.join(workdir, "decrypted")
+
+    for key_len in key_lengths:
+        public_key, private_key = rsa.key_gen(key_len)
+        for size in sizes:
+            with open(plain, "wb") as writer:
+                for offset in range(0, size, 1 << 20):
+                    writer.write(os.urandom(min(1 << 20, size - offset)))
+
+            for name in ("block", "hybrid"):
+                label = f"{key_len}/{size}"
+
+                times = measure(
+                    lambda: encdb.encrypt_file(
+                        plain, encrypted, public_key, name, config
+                    ),
+                    repeat,
+                )
+                results[f"{name}_encrypt/{label}"] = summarize(times, size)
+
+                times = measure(
+                    lambda: compress.decrypt_file(
+                        encrypted,
+                        decrypted,
+                        private_key,
+                        workers=config["workers"],
+                        buffer_size=config["buffer_size"],
+                        use_mmap=config["mmap"],
+                    ),
+                    repeat,
+                )
+                results[f"{name}_decrypt/{label}"] = summarize(times, size)
+
+    return results
+
+
+def bench_db(rows: int, repeat: int, workdir: str) -> dict:
+    """Benchmark the db.dbconn helpers on a database of rows files.
+
+    Arguments:
+        rows: the number of files rows to create.
+        repeat: the number of runs per lookup benchmark.
+        workdir: a directory for the database.
+
+    Returns:
+        The summaries, by benchmark name.
+    """
+    results = {}
+    db.connect(os.path.join(workdir, "bench.db"))
+    try:
+        user_id = db.add_user("bench")
+        key_id = db.add_key(user_id, 65537, (1 << 2047) + 1)
+        files = [
+            (f"file{i}", f"/encrypted/bench/file{i}", key_id, user_id)
+            for i in range(rows)
+        ]
+
+        times = measure(lambda: db.add_files(files), 1)
+        results[f"db_add_files/{rows}"] = summarize(times)
+        results[f"db_add_files/{rows}"]["rows_per_s"] = rows / times[0]
+
+        def lookup():
+            db.get_file_by_filename(user_id, f"file{random.randrange(rows)}")
+
+        times = measure(lookup, repeat * 100)
+        results[f"db_get_file_by_filename/{rows}"] = summarize(times)
+
+        db.update_user(key_id, user_id)
+        times = measure(
+            lambda: db.get_current_public_key(user_id), repeat * 100
+        )
+        results["db_get_current_public_key"] = summarize(times)
+
+        times = measure(lambda: db.get_file_names_by_user_id(user_id), repeat)
+        results[f"db_get_file_names_by_user_id/{rows}"] = summarize(times)
+
+        times = measure(lambda: db.get_files_by_user_id(user_id), repeat)
+        results[f"db_get_files_by_user_id/{rows}"] = summarize(times)
+
+        names = [file[0] for file in files]
+        times = measure(lambda: db.delete_files(user_id, names), 1)
+        results[f"db_delete_files/{rows}"] = summarize(times)
+    finally:
+        db.disconnect()
+
+    return results
+
+
+def _python(code: str) -> str:
+    """Run code in a fresh interpreter from the repository root.
+
+    Arguments:
+        code: the Python source to run.
+
+    Returns:
+        What the code printed.
+    """
+    return subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        check=True,
+        cwd=ROOT,
+        text=True,
+    ).stdout
+
+
+def bench_startup(repeat: int) -> dict:
+    """Benchmark the interpreter startup with and without encdb.
+
+    Arguments:
+        repeat: the number of runs per benchmark.
+
+    Returns:
+        The summaries, by benchmark name.
+    """
+    return {
+        "startup/python": summarize(measure(lambda: _python("pass"), repeat)),
+        "startup/import_encdb": summarize(
+            measure(lambda: _python("import encdb"), repeat)
+        ),
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """List the benchmarks that got slower than the baseline.
+
+    Arguments:
+        results: the current summaries, by benchmark name.
+        baseline: the baseline summaries, by benchmark name.
+        threshold: the p50 slowdown ratio reported as a regression.
+
+    Returns:
+        One line per regression.
+    """
+    regressions = []
+    for name, summary in results.items():
+        if name not in baseline or not baseline[name]["p50_ms"]:
+            continue
+
+        ratio = summary["p50_ms"] / baseline[name]["p50_ms"]
+        if ratio > threshold:
+            regressions.append(f"{name}: p50 {ratio:.2f}x the baseline")
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="bench", description="benchmarks EncryptedDatabase"
+    )
+    parser.add_argument(
+        "--key-lengths", nargs="+", type=int, default=[1024, 2048]
+    )
+    parser.add_argument("--sizes", nargs="+", type=str, default=["64K", "1M"])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="worker processes for block files",
+    )
+    parser.add_argument(
+        "--buffer-size",
+        type=str,
+        default=str(utils.DEFAULT_BUFFER_SIZE),
+        help="I/O buffer size for block files",
+    )
+    parser.add_argument(
+        "--mmap", action="store_true", help="memory-map block files"
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--only",
+        nargs="+",
+        choices=["keys", "files", "db", "startup"],
+        default=["keys", "files", "db", "startup"],
+    )
+    parser.add_argument("--output", help="file for the JSON results")
+    parser.add_argument("--baseline", help="JSON results to compare with")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.2,
+        help="p50 slowdown ratio reported as a regression",
+    )
+    args = parser.parse_args()
+    config = {
+        "workers": args.workers,
+        "buffer_size": parse_size(args.buffer_size),
+        "mmap": args.mmap,
+    }
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        if "keys" in args.only:
+            results.update(bench_keys(args.key_lengths, args.repeat))
+        if "files" in args.only:
+            sizes = [parse_size(x) for x in args.sizes]
+            results.update(
+                bench_files(
+                    args.key_lengths, sizes, args.repeat, workdir, config
+                )
+            )
+        if "db" in args.only:
+            results.update(bench_db(args.rows, args.repeat, workdir))
+        if "startup" in args.only:
+            results.update(bench_startup(max(args.repeat, 5)))
+
+    for name, summary in results.items():
+        line = f"{name}: {summary['ops_per_s']:.2f} ops/s"
+        if "mb_per_s" in summary:
+            line += f", {summary['mb_per_s']:.3f} MB/s"
+        line += (
+            f", p50 {summary['p50_ms']:.2f} ms"
+            f", p90 {summary['p90_ms']:.2f} ms"
+            f", p99 {summary['p99_ms']:.2f} ms"
+        )
+        print(line)
+
+    report = {
+        "machine": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpus": os.cpu_count(),
+        },
+        "settings": config,
+        "results": results,
+    }
+    if args.output is not None:
+        with open(args.output, "w") as writer:
+            json.dump(report, writer, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as reader:
+            baseline = json.load(reader)["results"]
+
+        regressions = compare(results, baseline, args.threshold)
+        for line in regressions:
+            print(f"regression: {line}")
+        if regressions:
+            sys.exit(1)
@@ -1,70 +1,440 @@
 """This module provides functions to manage users, keys, and files in a db.
 
+The helpers run on the connection opened by connect(), or on the
+connection a ConnectionPool has bound to the calling thread.
+
+Public keys are stored as little-endian BLOBs. get_public_key() and
+get_current_public_key() return them decoded, through an in-process LRU
+cache keyed by database and key id, so repeated operations don't query
+and decode the same key again. Key ids are never reused (AUTOINCREMENT),
+so a cached key stays the key of its id.
+
+Classes:
+    Connection: A SQLite connection whose schema is checked once.
+    ConnectionPool: A thread-safe pool of connections to one database.
+
 Functions:
-    connect(filepath: str): Creates a connection to the database and a cursor.
-    disconnect(): Closes the database connection and cursor.
+    connect(filepath: str, pragmas: dict | None = None):
+        Creates the default connection to the database.
+    settings() -> dict: Returns the SQLite settings in effect.
+    transaction(): Groups the helpers called in a with block
+        into one transaction.
+    disconnect(): Closes the default database connection.
+    is_connected() -> bool: Tells whether the default connection is open.
     add_user(username: str) -> int: Creates an entry in the user table.
     add_key(user_id: int, e: int, n: int) -> int: Creates an entry in the keys.
     add_file(filename: str, path: str,
         public_key_id: int, user_id: int) -> int:
         Creates a new entry in the files table.
+    add_keys(user_id: int, keys: list[tuple[int, int]]):
+        Creates several entries in the keys table.
+    add_files(files: list[tuple[str, str, int, int]]):
+        Creates several entries in the files table.
+    add_pooled_keys(key_length: int, key_pairs: list[bytes]):
+        Stores sealed key pairs in the key pool.
+    add_content(public_key_id: int, digest: bytes, path: str,
+        refs: int = 1) -> tuple[int, str, bool]:
+        Records the ciphertext of some content under a key.
     get_user_by_username(username: str) -> tuple[int, str, str] | None:
         Retrieves a user by their username.
-    get_key_by_key_id(key_id: int) -> tuple[int, int, str, str] | None:
+    get_key_by_key_id(key_id: int) -> tuple[int, int, bytes, bytes] | None:
         Retrieves a key from the database by its id.
-    get_keys_by_user_id(user_id: int) -> list[tuple[int, int, str, str]]:
+    get_keys_by_user_id(user_id: int) -> list[tuple[int, int, bytes, bytes]]:
         Retrieves all keys associated with a user.
-    get_current_key_for_user(user_id: int) -> tuple[int, int, str, str] | None:
+    get_current_key_for_user(user_id: int)
+        -> tuple[int, int, bytes, bytes] | None:
         Retrieves the current default key for a user.
+    get_public_key(key_id: int) -> tuple[int, int] | None:
+        Retrieves a decoded public key, through the key cache.
+    get_current_public_key(user_id: int)
+        -> tuple[int, tuple[int, int]] | None:
+        Retrieves the decoded default public key of a user.
+    clear_key_cache(): Empties the key cache.
     get_file_by_filename(user_id: int, filename: str)
         -> tuple[int, str, str, int, int] | None:
         Retrieves a file record by filename for a user.
     get_files_by_user_id(user_id: int) -> list[tuple[int, str, str, int, int]]:
         Retrieves all files associated with a user.
+    get_files_by_pattern(user_id: int, pattern: str)
+        -> list[tuple[int, str, str, int, int]]:
+        Retrieves the files of a user whose names match a glob pattern.
+    get_files_page(user_id: int, after_id: int, limit: int)
+        -> list[tuple[int, str, str, int, int]]:
+        Retrieves the next files of a user, in id order.
+    has_key(key_id: int) -> bool:
+        Checks whether a key exists without fetching its key material.
+    get_key_ids_by_user_id(user_id: int) -> list[int]:
+        Retrieves the ids of a user's keys.
+    get_file_names_by_user_id(user_id: int) -> list[str]:
+        Retrieves the names of a user's files.
+    get_file_paths_by_user_id(user_id: int) -> list[str]:
+        Retrieves the storage paths of a user's files.
+    count_pooled_keys(key_length: int) -> int:
+        Counts the key pairs of a given length in the key pool.
+    get_content(public_key_id: int, digest: bytes)
+        -> tuple[int, int, bytes, str, int] | None:
+        Retrieves the stored ciphertext of some content under a key.
+    get_content_by_path(path: str)
+        -> tuple[int, int, bytes, str, int] | None:
+        Retrieves the contents record of a stored ciphertext.
+    get_chunks(file_id: int) -> list[bytes]:
+        Retrieves the chunk manifest of a file.
+    reference_content(content_id: int, count: int = 1):
+        Adds files that share a stored ciphertext.
     update_user(new_current_key_id: int, user_id: int):
         Changes the default public key for a user.
+    update_file(file_id: int, path: str, public_key_id: int):
+        Points a file to another ciphertext.
+    update_content(content_id: int, digest: bytes, path: str):
+        Records that a stored ciphertext was updated.
+    set_chunks(file_id: int, digests: list[bytes]):
+        Replaces the chunk manifest of a file.
     delete_user(user_id: int): Deletes an entry in the users table.
     delete_key(key_id: int): Deletes an entry in the keys table.
     delete_file(user_id: int, filename: str):
         Deletes an entry in the files table.
+    delete_files(user_id: int, filenames: list[str]):
+        Deletes several entries in the files table.
+    pop_pooled_key(key_length: int) -> bytes | None:
+        Removes a key pair from the key pool and returns it.
+    release_content(path: str) -> bool:
+        Drops a reference to a stored ciphertext.
 """
 
 import os
+import queue
 import sqlite3
+import sys
+import threading
+import scrypt.timing as timing
+from collections import OrderedDict
+from contextlib import contextmanager
+
+SCHEMA_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "schema.sql"
+)
+SCHEMA_VERSION = 8
+STATEMENT_CACHE_SIZE = 256
+KEY_CACHE_SIZE = 256
+
+PRAGMAS = (
+    "journal_mode",
+    "synchronous",
+    "cache_size",
+    "mmap_size",
+    "busy_timeout",
+    "temp_store",
+)
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "temp_store": "MEMORY",
+}
+
+KEYS_MIGRATION = """
+PRAGMA foreign_keys = OFF;
+BEGIN;
+CREATE TABLE keys_v8 (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  user_id INTEGER,
+  e BLOB,
+  n BLOB,
+  FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+);
+INSERT INTO keys_v8 (id, user_id, e, n) SELECT id, user_id, e, n FROM keys;
+DROP TABLE keys;
+ALTER TABLE keys_v8 RENAME TO keys;
+COMMIT;
+PRAGMA foreign_keys = ON;
+"""
+
+_default = None
+_local = threading.local()
+_key_cache = OrderedDict()
+_key_cache_lock = threading.Lock()
+
+
+class Connection:
+    """A SQLite connection whose schema is checked once, when it is opened.
+
+    Statements are compiled once per connection and kept in the sqlite3
+    statement cache, so the helpers of this module reuse them.
+
+    Attributes:
+        con: the underlying sqlite3 connection.
+        depth: the nesting level of transaction() blocks.
+        database: identifies the database in the key cache: its path
+            and inode, so a database created again at the same path
+            (whose key ids start over) is another one.
+    """
+
+    def __init__(
+        self,
+        filepath: str,
+        check_same_thread: bool = True,
+        pragmas: dict | None = None,
+    ):
+        """Open the database and create or upgrade its schema if needed.
+
+        Args:
+            filepath: path to the SQLite database file.
+            check_same_thread: whether only the creating thread may use
+                the connection.
+            pragmas: settings applied over DEFAULT_PRAGMAS.
+
+        Raises:
+            ValueError: if a pragma is not supported or has an invalid value.
+        """
+        self.con = sqlite3.connect(
+            filepath,
+            cached_statements=STATEMENT_CACHE_SIZE,
+            check_same_thread=check_same_thread,
+        )
+        self.con.execute("PRAGMA foreign_keys=ON")
+        self.depth = 0
+        if filepath == ":memory:":
+            self.database = f":memory:{id(self)}"
+        else:
+            self.database = (
+                os.path.realpath(filepath),
+                os.stat(filepath).st_ino,
+            )
+        self.apply_pragmas({**DEFAULT_PRAGMAS, **(pragmas or {})})
+        self.ensure_schema()
+
+    def apply_pragmas(self, pragmas: dict):
+        """Apply performance settings to the connection.
+
+        Args:
+            pragmas: a mapping from names in PRAGMAS to integer
+                or keyword values.
+
+        Raises:
+            ValueError: if a pragma is not supported or has an invalid value.
+        """
+        for name, value in pragmas.items():
+            if name not in PRAGMAS:
+                raise ValueError(f"unsupported pragma {name}")
+            if not isinstance(value, int) and not (
+                isinstance(value, str) and value.isidentifier()
+            ):
+                raise ValueError(f"invalid value for pragma {name}")
+
+            self.con.execute(f"PRAGMA {name} = {value}").fetchall()
+
+    def settings(self) -> dict:
+        """Return the values of PRAGMAS in effect on this connection."""
+        return {
+            name: self.con.execute(f"PRAGMA {name}").fetchone()[0]
+            for name in PRAGMAS
+        }
+
+    def schema_version(self) -> int | None:
+        """Return the schema version of the database.
+
+        Databases created before the schema was versioned have a
+        user_version of 0, like new ones, but already have tables; they
+        are version 0 and are upgraded like any older version.
+
+        Returns:
+            the version, or None if the database has no tables yet.
+        """
+        version = self.con.execute("PRAGMA user_version").fetchone()[0]
+        if version == 0 and not self.con.execute(
+            "SELECT 1 FROM sqlite_master "
+            "WHERE type = 'table' AND name = 'users'"
+        ).fetchone():
+            return None
+        return version
+
+    def ensure_schema(self):
+        """Run schema.sql only if the database is older than SCHEMA_VERSION."""
+        version = self.schema_version()
+        if version is not None and version >= SCHEMA_VERSION:
+            return
+
+        with open(SCHEMA_PATH, "r") as reader:
+            sql = reader.read()
+
+        if version is not None and version < 8:
+            # key ids were reused before version 8, which the key cache
+            # can't tell apart; the table is rebuilt with AUTOINCREMENT
+            # and its index is created again by schema.sql
+            self.con.executescript(KEYS_MIGRATION)
+        self.con.executescript(sql)
+        if version is not None and version < 5:
+            # keys were stored in base64 before version 5
+            import base64
+
+            self.con.create_function(
+                "b64decode", 1, base64.b64decode, deterministic=True
+            )
+            self.con.execute(
+                "UPDATE keys SET e = b64decode(e), n = b64decode(n)"
+            )
+        self.con.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.con.commit()
+
+    def execute(self, sql: str, parameters=()) -> sqlite3.Cursor:
+        """Execute a statement and return its cursor."""
+        with timing.phase("sqlite"):
+            return self.con.execute(sql, parameters)
+
+    def executemany(self, sql: str, parameters) -> sqlite3.Cursor:
+        """Execute a statement once per parameter set."""
+        with timing.phase("sqlite"):
+            return self.con.executemany(sql, parameters)
+
+    def commit(self):
+        """Commit the current transaction, unless inside transaction()."""
+        if self.depth == 0:
+            with timing.phase("sqlite"):
+                self.con.commit()
+
+    @contextmanager
+    def transaction(self):
+        """Group the statements run inside the block into one transaction.
+
+        Commits made by the helpers inside the block are deferred to its
+        end; an exception rolls the whole block back.
 
-con = None
-cursor = None
+        Yields:
+            this connection.
+        """
+        self.depth += 1
+        try:
+            yield self
+        except BaseException:
+            self.depth -= 1
+            if self.depth == 0:
+                self.con.rollback()
+            raise
 
+        self.depth -= 1
+        self.commit()
 
-def connect(filepath: str):
-    """Create a connection to the database and a cursor associated with it.
+    def close(self):
+        """Refresh the query planner statistics and close the connection."""
+        self.con.execute("PRAGMA optimize")
+        self.con.close()
+
+
+class ConnectionPool:
+    """A thread-safe pool of connections to one database.
+
+    Connections are opened lazily, up to size of them, and handed out by
+    connection(). While a thread holds one, the helpers of this module
+    use it instead of the connection opened by connect().
+    """
+
+    def __init__(self, filepath: str, size: int, pragmas: dict | None = None):
+        """Create an empty pool.
+
+        Args:
+            filepath: path to the SQLite database file.
+            size: the maximum number of open connections.
+            pragmas: settings applied to every connection.
+        """
+        self.filepath = filepath
+        self.size = size
+        self.pragmas = pragmas
+        self._idle = queue.Queue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def _acquire(self) -> Connection:
+        """Take an idle connection, opening one if the pool isn't full."""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._opened < self.size:
+                self._opened += 1
+                return Connection(
+                    self.filepath,
+                    check_same_thread=False,
+                    pragmas=self.pragmas,
+                )
+
+        return self._idle.get()
+
+    @contextmanager
+    def connection(self):
+        """Bind a pooled connection to the current thread.
+
+        Yields:
+            the Connection used by this module's helpers until the block
+            exits.
+        """
+        con = self._acquire()
+        previous = getattr(_local, "connection", None)
+        _local.connection = con
+        try:
+            yield con
+        finally:
+            _local.connection = previous
+            self._idle.put(con)
+
+    def close(self):
+        """Close the idle connections of the pool."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def _connection() -> Connection:
+    """Return the connection bound to this thread, or the default one."""
+    con = getattr(_local, "connection", None)
+    if con is not None:
+        return con
+
+    return _default
+
+
+def connect(filepath: str, pragmas: dict | None = None):
+    """Create the default connection to the database.
 
     If the database doesn't exist, the function creates it.
-    This function must be called before any other functions from this module.
+    This function must be called before any other functions from this module,
+    unless a ConnectionPool is used.
 
      Args:
         filepath: path to the SQLite database file.
+        pragmas: settings applied over DEFAULT_PRAGMAS.
     """
-    global con
-    global cursor
-    con = sqlite3.connect(filepath)
-    cursor = con.cursor()
+    global _default
+    _default = Connection(filepath, pragmas=pragmas)
 
-    dir = os.path.dirname(filepath)
-    path = os.path.join(dir, "db", "schema.sql")
-    with open(path, "r") as reader:
-        sql = reader.read()
 
-    cursor.executescript(sql)
-    cursor.execute("PRAGMA foreign_keys=ON")
-    con.commit()
+def settings() -> dict:
+    """Return the SQLite settings in effect on the current connection."""
+    return _connection().settings()
+
+
+def transaction():
+    """Group the helpers called inside a with block into one transaction.
+
+    Returns:
+        a context manager for the current connection.
+    """
+    return _connection().transaction()
 
 
 def disconnect():
-    """Close the database connection and cursor."""
-    global con, cursor
-    cursor.close()
-    con.close()
+    """Close the default database connection."""
+    global _default
+    _default.close()
+    _default = None
+
+
+def is_connected() -> bool:
+    """Tell whether the default connection is open."""
+    return _default is not None
 
 
 # CREATE
@@ -77,13 +447,25 @@ def add_user(username: str) -> int:
     Returns:
         The id of the new user.
     """
-    global con, cursor
-    cursor.execute("INSERT INTO users (username) VALUES (?)", (username,))
+    con = _connection()
+    cursor = con.execute(
+        "INSERT INTO users (username) VALUES (?)", (username,)
+    )
     id = cursor.lastrowid
     con.commit()
     return id
 
 
+def _encode_number(x: int) -> bytes:
+    """Encode a key number into its BLOB form."""
+    return x.to_bytes((x.bit_length() + 7) // 8, byteorder=sys.byteorder)
+
+
+def _decode_number(blob: bytes) -> int:
+    """Decode a key number from its BLOB form."""
+    return int.from_bytes(blob, byteorder=sys.byteorder)
+
+
 def add_key(user_id: int, e: int, n: int) -> int:
     """Create an entry in the keys table.
 
@@ -95,9 +477,10 @@ def add_key(user_id: int, e: int, n: int) -> int:
     Returns:
         the id of the new key.
     """
-    global con, cursor
-    cursor.execute(
-        "INSERT INTO keys (user_id, e, n) VALUES (?, ?, ?)", (user_id, e, n)
+    con = _connection()
+    cursor = con.execute(
+        "INSERT INTO keys (user_id, e, n) VALUES (?, ?, ?)",
+        (user_id, _encode_number(e), _encode_number(n)),
     )
     id = cursor.lastrowid
     con.commit()
@@ -118,8 +501,8 @@ def add_file(
     Returns:
         the id of the new file.
     """
-    global con, cursor
-    cursor.execute(
+    con = _connection()
+    cursor = con.execute(
         """INSERT INTO files
                    (filename, path, public_key_id, user_id)
                    VALUES (?, ?, ?, ?)""",
@@ -130,6 +513,92 @@ def add_file(
     return id
 
 
+def add_keys(user_id: int, keys: list[tuple[int, int]]):
+    """Create several entries in the keys table in one transaction.
+
+    Args:
+        user_id: the id of the user to whom the keys belong.
+        keys: (e, n) pairs of public keys.
+    """
+    con = _connection()
+    con.executemany(
+        "INSERT INTO keys (user_id, e, n) VALUES (?, ?, ?)",
+        [(user_id, _encode_number(e), _encode_number(n)) for e, n in keys],
+    )
+    con.commit()
+
+
+def add_files(files: list[tuple[str, str, int, int]]):
+    """Create several entries in the files table in one transaction.
+
+    Args:
+        files: (filename, path, public_key_id, user_id) tuples.
+    """
+    con = _connection()
+    con.executemany(
+        """INSERT INTO files
+                   (filename, path, public_key_id, user_id)
+                   VALUES (?, ?, ?, ?)""",
+        files,
+    )
+    con.commit()
+
+
+def add_pooled_keys(key_length: int, key_pairs: list[bytes]):
+    """Store sealed key pairs in the key pool.
+
+    Args:
+        key_length: the length of the keys in bits.
+        key_pairs: the sealed key pairs.
+    """
+    con = _connection()
+    con.executemany(
+        "INSERT INTO key_pool (key_length, key_pair) VALUES (?, ?)",
+        [(key_length, key_pair) for key_pair in key_pairs],
+    )
+    con.commit()
+
+
+def add_content(
+    public_key_id: int, digest: bytes, path: str, refs: int = 1
+) -> tuple[int, str, bool]:
+    """Record the ciphertext of some content under a key.
+
+    If the content was recorded under the key in the meantime (e.g. by
+    another process), the references are added to that record instead.
+
+    Args:
+        public_key_id: the id of the key the content is encrypted with.
+        digest: the keyed digest of the plaintext.
+        path: the path of the ciphertext.
+        refs: the number of files records that use the ciphertext.
+
+    Returns:
+        the id and the path of the contents record holding the references,
+        and whether it was created, i.e. whether the ciphertext has to be
+        moved to path.
+    """
+    con = _connection()
+    with con.transaction():
+        row = con.execute(
+            """INSERT INTO contents (public_key_id, digest, path, refs)
+                       VALUES (?, ?, ?, ?)
+                       ON CONFLICT (public_key_id, digest) DO NOTHING
+                       RETURNING id""",
+            (public_key_id, digest, path, refs),
+        ).fetchall()
+        if row:
+            return row[0][0], path, True
+
+        row = con.execute(
+            """UPDATE contents SET refs = refs + ?
+                       WHERE public_key_id = ? and digest = ?
+                       RETURNING id, path""",
+            (refs, public_key_id, digest),
+        ).fetchall()
+        return row[0][0], row[0][1], False
+
+
 # READ
 def get_user_by_username(username: str) -> tuple[int, str, str] | None:
     """Retrieve a user from the database by their username.
@@ -140,13 +609,13 @@ def get_user_by_username(username: str) -> tuple[int, str, str] | None:
     Returns:
         the user record, or None if the user is not found.
     """
-    global con, cursor
-    cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
+    con = _connection()
+    cursor = con.execute("SELECT * FROM users WHERE username = ?", (username,))
     user = cursor.fetchone()
     return user
 
 
-def get_key_by_key_id(key_id: int) -> tuple[int, int, str, str] | None:
+def get_key_by_key_id(key_id: int) -> tuple[int, int, bytes, bytes] | None:
     """Retrieve a key from the database by its id.
 
     Args:
@@ -155,13 +624,13 @@ def get_key_by_key_id(key_id: int) -> tuple[int, int, str, str] | None:
     Returns:
         the key record, or None if the key is not found.
     """
-    global con, cursor
-    cursor.execute("SELECT * FROM keys WHERE id = ?", (key_id,))
+    con = _connection()
+    cursor = con.execute("SELECT * FROM keys WHERE id = ?", (key_id,))
     key = cursor.fetchone()
     return key
 
 
-def get_keys_by_user_id(user_id: int) -> list[tuple[int, int, str, str]]:
+def get_keys_by_user_id(user_id: int) -> list[tuple[int, int, bytes, bytes]]:
     """Retrieve all keys associated with a user from the database.
 
     Args:
@@ -170,13 +639,15 @@ def get_keys_by_user_id(user_id: int) -> list[tuple[int, int, str, str]]:
     Returns:
         a list of key records, or an empty list if no keys are found.
     """
-    global con, cursor
-    cursor.execute("SELECT * FROM keys WHERE user_id = ?", (user_id,))
+    con = _connection()
+    cursor = con.execute("SELECT * FROM keys WHERE user_id = ?", (user_id,))
     key = cursor.fetchall()
     return key
 
 
-def get_current_key_for_user(user_id: int) -> tuple[int, int, str, str] | None:
+def get_current_key_for_user(
+    user_id: int,
+) -> tuple[int, int, bytes, bytes] | None:
     """Retrieve the current default key for a user.
 
     Args:
@@ -185,8 +656,8 @@ def get_current_key_for_user(user_id: int) -> tuple[int, int, str, str] | None:
     Returns:
         a key record, or None if the key is not found.
     """
-    global con, cursor
-    cursor.execute(
+    con = _connection()
+    cursor = con.execute(
         """SELECT k.* FROM users u
                    JOIN keys k ON u.current_key_id = k.id
                    WHERE u.id = ?""",
@@ -196,6 +667,67 @@ def get_current_key_for_user(user_id: int) -> tuple[int, int, str, str] | None:
     return current_key
 
 
+def get_public_key(key_id: int) -> tuple[int, int] | None:
+    """Retrieve a decoded public key, through the key cache.
+
+    Args:
+        key_id: The id of the key.
+
+    Returns:
+        the public key (e, n), or None if the key is not found.
+    """
+    con = _connection()
+    cache_key = (con.database, key_id)
+    with _key_cache_lock:
+        key = _key_cache.get(cache_key)
+        if key is not None:
+            _key_cache.move_to_end(cache_key)
+            return key
+
+    cursor = con.execute("SELECT e, n FROM keys WHERE id = ?", (key_id,))
+    record = cursor.fetchone()
+    if record is None:
+        return None
+
+    key = (_decode_number(record[0]), _decode_number(record[1]))
+    with _key_cache_lock:
+        _key_cache[cache_key] = key
+        if len(_key_cache) > KEY_CACHE_SIZE:
+            _key_cache.popitem(last=False)
+    return key
+
+
+def get_current_public_key(
+    user_id: int,
+) -> tuple[int, tuple[int, int]] | None:
+    """Retrieve the decoded default public key of a user.
+
+    Args:
+        user_id: The id of the user.
+
+    Returns:
+        a tuple (key_id, (e, n)), or None if the user has no default key.
+    """
+    con = _connection()
+    cursor = con.execute(
+        "SELECT current_key_id FROM users WHERE id = ?", (user_id,)
+    )
+    record = cursor.fetchone()
+    if record is None or record[0] is None:
+        return None
+
+    key = get_public_key(record[0])
+    if key is None:
+        return None
+    return record[0], key
+
+
+def clear_key_cache():
+    """Empty the key cache."""
+    with _key_cache_lock:
+        _key_cache.clear()
+
+
 def get_file_by_filename(
     user_id: int, filename: str
 ) -> tuple[int, str, str, int, int] | None:
@@ -208,8 +740,8 @@ def get_file_by_filename(
     Returns:
         a file record, or None if the file is not found.
     """
-    global con, cursor
-    cursor.execute(
+    con = _connection()
+    cursor = con.execute(
         "SELECT * FROM files WHERE user_id = ? and filename = ?",
         (user_id, filename),
     )
@@ -226,12 +758,185 @@ def get_files_by_user_id(user_id: int) -> list[tuple[int, str, str, int, int]]:
     Returns:
         a list of file records, or an empty list if no files are found.
     """
-    global con, cursor
-    cursor.execute("SELECT * FROM files WHERE user_id = ?", (user_id,))
+    con = _connection()
+    cursor = con.execute("SELECT * FROM files WHERE user_id = ?", (user_id,))
     files = cursor.fetchall()
     return files
 
 
+def get_files_by_pattern(
+    user_id: int, pattern: str
+) -> list[tuple[int, str, str, int, int]]:
+    """Retrieve the files of a user whose names match a glob pattern.
+
+    Args:
+        user_id: the id of the user whose files are to be fetched.
+        pattern: a SQLite GLOB pattern (*, ? and [...] wildcards).
+
+    Returns:
+        a list of file records, or an empty list if no files match.
+    """
+    con = _connection()
+    cursor = con.execute(
+        "SELECT * FROM files WHERE user_id = ? and filename GLOB ?",
+        (user_id, pattern),
+    )
+    return cursor.fetchall()
+
+
+def get_files_page(
+    user_id: int, after_id: int, limit: int
+) -> list[tuple[int, str, str, int, int]]:
+    """Retrieve the next files of a user, in id order.
+
+    Args:
+        user_id: the id of the user whose files are to be fetched.
+        after_id: the id of the last file of the previous page, or 0.
+        limit: the maximum number of files to return.
+
+    Returns:
+        a list of file records, empty after the last page.
+    """
+    con = _connection()
+    cursor = con.execute(
+        "SELECT * FROM files WHERE user_id = ? and id > ? ORDER BY id LIMIT ?",
+        (user_id, after_id, limit),
+    )
+    return cursor.fetchall()
+
+
+def has_key(key_id: int) -> bool:
+    """Check whether a key exists without fetching its key material.
+
+    Args:
+        key_id: The id of the key.
+
+    Returns:
+        True if the key is in the database.
+    """
+    con = _connection()
+    cursor = con.execute("SELECT 1 FROM keys WHERE id = ?", (key_id,))
+    return cursor.fetchone() is not None
+
+
+def get_key_ids_by_user_id(user_id: int) -> list[int]:
+    """Retrieve the ids of a user's keys without their key material.
+
+    Args:
+        user_id: The id of the user whose keys are to be listed.
+
+    Returns:
+        a list of key ids.
+    """
+    con = _connection()
+    cursor = con.execute("SELECT id FROM keys WHERE user_id = ?", (user_id,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def get_file_names_by_user_id(user_id: int) -> list[str]:
+    """Retrieve the names of a user's files.
+
+    The query is answered from the (user_id, filename) index.
+
+    Args:
+        user_id: the id of the user whose files are to be listed.
+
+    Returns:
+        a list of file names.
+    """
+    con = _connection()
+    cursor = con.execute(
+        "SELECT filename FROM files WHERE user_id = ?", (user_id,)
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+def get_file_paths_by_user_id(user_id: int) -> list[str]:
+    """Retrieve the storage paths of a user's files.
+
+    The query is answered from the (user_id, path) index.
+
+    Args:
+        user_id: the id of the user whose files are to be listed.
+
+    Returns:
+        a list of paths.
+    """
+    con = _connection()
+    cursor = con.execute(
+        "SELECT path FROM files WHERE user_id = ?", (user_id,)
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+def count_pooled_keys(key_length: int) -> int:
+    """Count the key pairs of a given length in the key pool.
+
+    Args:
+        key_length: the length of the keys in bits.
+
+    Returns:
+        the number of pooled key pairs.
+    """
+    con = _connection()
+    cursor = con.execute(
+        "SELECT COUNT(*) FROM key_pool WHERE key_length = ?", (key_length,)
+    )
+    return cursor.fetchone()[0]
+
+
+def get_content(
+    public_key_id: int, digest: bytes
+) -> tuple[int, int, bytes, str, int] | None:
+    """Retrieve the stored ciphertext of some content under a key.
+
+    Args:
+        public_key_id: the id of the key the content is encrypted with.
+        digest: the keyed digest of the plaintext.
+
+    Returns:
+        the (id, public_key_id, digest, path, refs) record, or None.
+    """
+    con = _connection()
+    cursor = con.execute(
+        "SELECT * FROM contents WHERE public_key_id = ? and digest = ?",
+        (public_key_id, digest),
+    )
+    return cursor.fetchone()
+
+
+def get_content_by_path(path: str) -> tuple[int, int, bytes, str, int] | None:
+    """Retrieve the contents record of a stored ciphertext.
+
+    Args:
+        path: the path of the ciphertext.
+
+    Returns:
+        the (id, public_key_id, digest, path, refs) record, or None if
+        the file was stored without deduplication.
+    """
+    con = _connection()
+    cursor = con.execute("SELECT * FROM contents WHERE path = ?", (path,))
+    return cursor.fetchone()
+
+
+def get_chunks(file_id: int) -> list[bytes]:
+    """Retrieve the chunk manifest of a file.
+
+    Args:
+        file_id: the id of the file.
+
+    Returns:
+        the digests of the file's chunks in order, or an empty list if
+        the file has no manifest.
+    """
+    con = _connection()
+    cursor = con.execute(
+        "SELECT digest FROM chunks WHERE file_id = ? ORDER BY idx", (file_id,)
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
 # UPDATE
 def update_user(new_current_key_id: int, user_id: int):
     """Change the default public key for a specified user.
@@ -240,14 +945,76 @@ def update_user(new_current_key_id: int, user_id: int):
         user_id: the id of the user who made the request.
         new_current_key_id: the id of the new default public key.
     """
-    global con, cursor
-    cursor.execute(
+    con = _connection()
+    con.execute(
         "UPDATE users SET current_key_id = ? WHERE id = ?",
         (new_current_key_id, user_id),
     )
     con.commit()
 
 
+def update_file(file_id: int, path: str, public_key_id: int):
+    """Point a file to another ciphertext.
+
+    Args:
+        file_id: the id of the file.
+        path: the path of the new ciphertext.
+        public_key_id: the id of the key it is encrypted with.
+    """
+    con = _connection()
+    con.execute(
+        "UPDATE files SET path = ?, public_key_id = ? WHERE id = ?",
+        (path, public_key_id, file_id),
+    )
+    con.commit()
+
+
+def update_content(content_id: int, digest: bytes, path: str):
+    """Record that a stored ciphertext was updated.
+
+    Args:
+        content_id: the id of the contents record.
+        digest: the keyed digest of the new plaintext.
+        path: the new path of the ciphertext.
+    """
+    con = _connection()
+    con.execute(
+        "UPDATE contents SET digest = ?, path = ? WHERE id = ?",
+        (digest, path, content_id),
+    )
+    con.commit()
+
+
+def set_chunks(file_id: int, digests: list[bytes]):
+    """Replace the chunk manifest of a file.
+
+    Args:
+        file_id: the id of the file.
+        digests: the digests of the file's chunks, in order.
+    """
+    con = _connection()
+    con.execute("DELETE FROM chunks WHERE file_id = ?", (file_id,))
+    con.executemany(
+        "INSERT INTO chunks (file_id, idx, digest) VALUES (?, ?, ?)",
+        [(file_id, i, digest) for i, digest in enumerate(digests)],
+    )
+    con.commit()
+
+
+def reference_content(content_id: int, count: int = 1):
+    """Add files that share a stored ciphertext.
+
+    Args:
+        content_id: the id of the contents record.
+        count: the number of files added.
+    """
+    con = _connection()
+    con.execute(
+        "UPDATE contents SET refs = refs + ? WHERE id = ?", (count, content_id)
+    )
+    con.commit()
+
+
 # DELETE
 def delete_user(user_id):
     """Delete an entry in the keys table.
@@ -255,9 +1022,11 @@ def delete_user(user_id):
     Arguments:
         user_id: the id of the user to be deleted.
     """
-    global con, cursor
-    cursor.execute("DELETE FROM users WHERE id = ?", (user_id,))
+    con = _connection()
+    con.execute("DELETE FROM users WHERE id = ?", (user_id,))
     con.commit()
+    # the user's keys are deleted with it
+    clear_key_cache()
 
 
 def delete_key(key_id: int):
@@ -266,9 +1035,11 @@ def delete_key(key_id: int):
     Arguments:
         key_id: the id of the key to be deleted.
     """
-    global con, cursor
-    cursor.execute("DELETE FROM keys WHERE id = ?", (key_id,))
+    con = _connection()
+    con.execute("DELETE FROM keys WHERE id = ?", (key_id,))
     con.commit()
+    with _key_cache_lock:
+        _key_cache.pop((con.database, key_id), None)
 
 
 def delete_file(user_id: int, filename: str):
@@ -278,9 +1049,89 @@ def delete_file(user_id: int, filename: str):
         user_id: the id of the user who made the request.
         filename: the name of the file to be deleted.
     """
-    global con, cursor
-    cursor.execute(
+    con = _connection()
+    con.execute(
+        """DELETE FROM chunks WHERE file_id IN
+               (SELECT id FROM files WHERE user_id = ? and filename = ?)""",
+        (user_id, filename),
+    )
+    con.execute(
         "DELETE FROM files WHERE user_id = ? and filename = ?",
         (user_id, filename),
     )
     con.commit()
+
+
+def delete_files(user_id: int, filenames: list[str]):
+    """Delete several entries in the files table in one transaction.
+
+    Arguments:
+        user_id: the id of the user who made the request.
+        filenames: the names of the files to be deleted.
+    """
+    con = _connection()
+    con.executemany(
+        """DELETE FROM chunks WHERE file_id IN
+               (SELECT id FROM files WHERE user_id = ? and filename = ?)""",
+        [(user_id, filename) for filename in filenames],
+    )
+    con.executemany(
+        "DELETE FROM files WHERE user_id = ? and filename = ?",
+        [(user_id, filename) for filename in filenames],
+    )
+    con.commit()
+
+
+def pop_pooled_key(key_length: int) -> bytes | None:
+    """Remove a key pair from the key pool and return it.
+
+    Args:
+        key_length: the length of the key in bits.
+
+    Returns:
+        the sealed key pair, or None if the pool is empty.
+    """
+    # a single statement, so two processes never pop the same key pair
+    con = _connection()
+    cursor = con.execute(
+        "DELETE FROM key_pool WHERE id = "
+        "(SELECT id FROM key_pool WHERE key_length = ? LIMIT 1) "
+        "RETURNING key_pair",
+        (key_length,),
+    )
+    row = cursor.fetchone()
+    cursor.close()
+    con.commit()
+    return row[0] if row is not None else None
+
+
+def release_content(path: str) -> bool:
+    """Drop a reference to a stored ciphertext.
+
+    The contents record is deleted with its last reference. Call it
+    along with the deletion of the files record that held the reference.
+
+    Args:
+        path: the path of the files record being deleted.
+
+    Returns:
+        True if no files record uses the ciphertext anymore, so it can be
+        removed from the disk; files stored without deduplication always
+        return True.
+    """
+    con = _connection()
+    cursor = con.execute(
+        "SELECT id, refs FROM contents WHERE path = ?", (path,)
+    )
+    row = cursor.fetchone()
+    if row is None:
+        return True
+
+    if row[1] > 1:
+        con.execute(
+            "UPDATE contents SET refs = refs - 1 WHERE id = ?", (row[0],)
+        )
+    else:
+        con.execute("DELETE FROM contents WHERE id = ?", (row[0],))
+    con.commit()
+    return row[1] <= 1
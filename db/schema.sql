@@ -6,10 +6,10 @@ CREATE TABLE IF NOT EXISTS users (
 );
 
 CREATE TABLE IF NOT EXISTS keys (
-  id INTEGER PRIMARY KEY,
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
   user_id INTEGER,
-  e TEXT,
-  n TEXT,
+  e BLOB,
+  n BLOB,
   FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
 );
 
@@ -23,3 +23,33 @@ CREATE TABLE IF NOT EXISTS files (
   FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
   UNIQUE (user_id, filename)
 );
+
+CREATE TABLE IF NOT EXISTS key_pool (
+  id INTEGER PRIMARY KEY,
+  key_length INTEGER,
+  key_pair BLOB
+);
+
+CREATE TABLE IF NOT EXISTS contents (
+  id INTEGER PRIMARY KEY,
+  public_key_id INTEGER,
+  digest BLOB,
+  path TEXT UNIQUE,
+  refs INTEGER,
+  FOREIGN KEY (public_key_id) REFERENCES keys(id) ON DELETE CASCADE,
+  UNIQUE (public_key_id, digest)
+);
+
+CREATE TABLE IF NOT EXISTS chunks (
+  file_id INTEGER,
+  idx INTEGER,
+  digest BLOB,
+  PRIMARY KEY (file_id, idx),
+  FOREIGN KEY (file_id) REFERENCES files(id) ON DELETE CASCADE
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS users_current_key_id ON users(current_key_id);
+CREATE INDEX IF NOT EXISTS keys_user_id ON keys(user_id);
+CREATE INDEX IF NOT EXISTS files_public_key_id ON files(public_key_id);
+CREATE INDEX IF NOT EXISTS files_user_id_path ON files(user_id, path);
+CREATE INDEX IF NOT EXISTS key_pool_key_length ON key_pool(key_length);
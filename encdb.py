@@ -1,23 +1,51 @@
 """This module implements an enctyption tool.
 
+The subcommands run in the calling process, or are forwarded to a daemon
+started with the serve subcommand, which keeps the database connection
+and the worker pools open between requests.
+
 Functions:
     failure(msg, db): Handle errors
         by printing a message
         and disconnecting from the database.
     file_print(msg, path): Print or save the provided message to a file.
+    parse_key(text: str) -> tuple[int, ...]: Parse a private key.
+    encrypt_file(path_src: str, path_dest: str, key: tuple[int, int],
+        file_format: str, config: dict) -> str | None:
+        Encrypt a file with the I/O and compression settings of the config.
+    reencrypt(file, path_src: str, key_id: int, key: tuple[int, int],
+        file_format: str, config: dict) -> tuple[int, int]:
+        Replace a stored file with a new version of its source.
+    build_parser() -> argparse.ArgumentParser: Build the command line parser.
+    load_config() -> dict: Read config.json.
+    connect(config: dict): Open the database named in the config.
+    start_instrumentation(args): Enable the requested timings/profiling.
+    stop_instrumentation(args, profiler): Save the timings/profile.
+    run(args, config: dict, username: str): Run a parsed subcommand.
+    serve(socket_path: str, config: dict): Serve requests on a Unix socket.
+    forward(socket_path: str, argv: list[str]) -> int | None:
+        Run a command on the daemon.
+    main(argv=None) -> int: Run the command line tool.
 """
 
 import json
 import os
 import sys
 import base64
+import binascii
 import argparse
 import re
 import sqlite3
+from contextlib import redirect_stderr, redirect_stdout
+from functools import lru_cache
 import scrypt.rsa as rsa
+import scrypt.compress as compress
+import scrypt.timing as timing
 import scrypt.utils as utils
 import db.dbconn as db
 
+DB_BATCH_SIZE = 500
+
 
 def failure(msg, db):
     """Handle errors by printing the message and disconnecting from the database.
@@ -29,7 +57,7 @@ def failure(msg, db):
     print(msg)
     if db is not None:
         db.disconnect()
-    os._exit(-1)
+    sys.exit(-1)
 
 
 def file_print(msg, path):
@@ -48,40 +76,350 @@ def file_print(msg, path):
             with open(path, "a+") as writer:
                 writer.write(f"{msg}\n")
         except (FileNotFoundError, PermissionError):
-            failure(f"couldn't write in file {args.output}", db)
+            failure(f"couldn't write in file {path}", db)
 
 
-if __name__ == "__main__":
+@lru_cache(maxsize=64)
+def parse_key(text: str) -> tuple[int, ...]:
+    """Parse a private key.
+
+    Arguments:
+        text: "(d, n)" or "(d, n, p, q, dp, dq, qinv)", base64 fields.
+
+    Returns:
+        The key as a tuple of integers.
+
+    Raises:
+        ValueError: if the key is malformed.
+    """
+    fields = re.split(r"[,\s]+", text.strip().strip("()").strip())
+    if len(fields) not in (2, 7):
+        raise ValueError("invalid key format")
+
+    try:
+        return tuple(
+            int.from_bytes(
+                base64.b64decode(field, validate=True),
+                byteorder=sys.byteorder,
+            )
+            for field in fields
+        )
+    except binascii.Error:
+        raise ValueError("invalid key format")
+
+
+def encrypt_file(
+    path_src: str,
+    path_dest: str,
+    key: tuple[int, int],
+    file_format: str,
+    config: dict,
+) -> str | None:
+    """Encrypt a file with the I/O and compression settings of the config.
+
+    Arguments:
+        path_src: The path to the source file to be encrypted.
+        path_dest: The path to save the encrypted file.
+        key: The public key (e, n).
+        file_format: "block" or "hybrid".
+        config: The configuration read by load_config.
+
+    Returns:
+        The algorithm the file was compressed with, or None.
+
+    Raises:
+        ValueError: if the key is too short for the format, or the
+            compression algorithm is not available.
+    """
+    return compress.encrypt_file(
+        path_src,
+        path_dest,
+        key,
+        file_format,
+        config.get("compression"),
+        config.get("compression_level"),
+        workers=config.get("workers", 1),
+        buffer_size=config.get("buffer_size", utils.DEFAULT_BUFFER_SIZE),
+        use_mmap=config.get("mmap", False),
+    )
+
+
+def _manifest(path: str, digests: list[bytes]) -> list[bytes]:
+    """Return the chunk manifest to record for a stored file.
+
+    Only uncompressed block files can be updated chunk by chunk.
+
+    Arguments:
+        path: The path of the encrypted file.
+        digests: The chunk digests of its source.
+
+    Returns:
+        digests, or an empty manifest.
+    """
+    if compress.file_info(path) == ("block", None):
+        return digests
+
+    return []
+
+
+def _add_batch(
+    contents: list[tuple[str, bytes, str, list[str]]],
+    files: list[tuple[str, str, int, int]],
+    key_id: int,
+    user_id: int,
+):
+    """Record a batch of encrypted files in one transaction.
+
+    New content is moved from its temporary path into place once it is
+    recorded, or dropped if another process recorded it first. Both
+    lists are emptied.
+
+    Arguments:
+        contents: (temporary path, digest, encrypted path, filenames)
+            tuples, one per new deduplicated content.
+        files: (filename, path, key_id, user_id) tuples of the files
+            stored without deduplication.
+        key_id: The id of the public key of the batch.
+        user_id: The id of the user.
+    """
+    try:
+        with db.transaction():
+            for output_path, digest, path, names in contents:
+                _, path, created = db.add_content(
+                    key_id, digest, path, len(names)
+                )
+                if created:
+                    os.replace(output_path, path)
+                files.extend(
+                    (filename, path, key_id, user_id) for filename in names
+                )
+            db.add_files(files)
+    finally:
+        for output_path, _, _, _ in contents:
+            if os.path.exists(output_path):
+                os.remove(output_path)
+        contents.clear()
+        files.clear()
+
+
+def reencrypt(
+    file: tuple[int, str, str, int, int],
+    path_src: str,
+    dir_path: str,
+    key_id: int,
+    key: tuple[int, int],
+    digest_key: bytes | None,
+    file_format: str,
+    config: dict,
+) -> tuple[int, int]:
+    """Replace a stored file with a new version of its source.
+
+    When the stored file is an uncompressed block file under the same
+    key, has a chunk manifest and doesn't share its ciphertext, and
+    compression is off, only the chunks whose digest changed are
+    re-encrypted, in place. Otherwise the file is encrypted again.
+
+    Arguments:
+        file: The files record of the stored file.
+        path_src: The path to the new version of the source file.
+        dir_path: The directory of the user's encrypted files.
+        key_id: The id of the public key to use.
+        key: The public key (e, n).
+        digest_key: The key of the content digests, or None when no
+            digest secret is configured; a deduplicated ciphertext is
+            then replaced by a file of its own.
+        file_format: "block" or "hybrid".
+        config: The configuration read by load_config.
+
+    Returns:
+        The number of chunks re-encrypted and the number of chunks.
+
+    Raises:
+        ValueError: if the key is too short for the format, or the
+            compression algorithm is not available.
+    """
+    file_id, _, path, old_key_id = file[:4]
+    chunk_size = rsa.chunk_size(key)
+    # without a digest secret there are no digests to compare
+    digest = digests = None
+    if digest_key is not None:
+        digest, digests = utils.file_digests(path_src, digest_key, chunk_size)
+        chunks = len(digests)
+    else:
+        chunks = -(-os.path.getsize(path_src) // chunk_size)
+    manifest = db.get_chunks(file_id) if file_format == "block" else []
+    content = db.get_content_by_path(path)
+
+    stored_format, algorithm = compress.file_info(path)
+    incremental = (
+        manifest
+        and digests is not None
+        and old_key_id == key_id
+        and (content is None or content[4] == 1 and digest_key is not None)
+        and stored_format == "block"
+        and algorithm is None
+        and config.get("compression") is None
+    )
+    if incremental:
+        changed = [
+            i
+            for i, digest in enumerate(digests)
+            if i >= len(manifest) or manifest[i] != digest
+        ]
+    else:
+        changed = list(range(chunks))
+
+    if content is None:
+        if incremental:
+            rsa.update_file(path_src, path, key, changed)
+        else:
+            output_path = utils.temp_path(path)
+            encrypt_file(path_src, output_path, key, file_format, config)
+            os.replace(output_path, path)
+        with db.transaction():
+            db.update_file(file_id, path, key_id)
+            db.set_chunks(file_id, _manifest(path, digests or []))
+        return len(changed), chunks
+
+    # the ciphertext is deduplicated: keep it named after its content
+    existing = None
+    if digest is not None:
+        existing = db.get_content(key_id, digest)
+    if existing is not None and existing[0] == content[0]:
+        if stored_format == file_format:
+            changed = []
+        else:
+            # same content in another format, for every file sharing it
+            output_path = utils.temp_path(path)
+            encrypt_file(path_src, output_path, key, file_format, config)
+            os.replace(output_path, path)
+    elif existing is not None:
+        with db.transaction():
+            db.reference_content(existing[0])
+            unused = db.release_content(path)
+            db.update_file(file_id, existing[3], key_id)
+        if unused:
+            os.remove(path)
+        path = existing[3]
+        changed = []
+    else:
+        if digest is None:
+            new_path = os.path.join(dir_path, file[1])
+        else:
+            new_path = utils.object_path(dir_path, key_id, digest)
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        if incremental:
+            rsa.update_file(path_src, path, key, changed)
+            with db.transaction():
+                db.update_content(content[0], digest, new_path)
+                db.update_file(file_id, new_path, key_id)
+                os.replace(path, new_path)
+        else:
+            output_path = utils.temp_path(new_path)
+            try:
+                encrypt_file(path_src, output_path, key, file_format, config)
+                with db.transaction():
+                    unused = db.release_content(path)
+                    created = True
+                    if digest is not None:
+                        _, new_path, created = db.add_content(
+                            key_id, digest, new_path
+                        )
+                    if created:
+                        os.replace(output_path, new_path)
+                    db.update_file(file_id, new_path, key_id)
+            finally:
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+            if unused:
+                os.remove(path)
+        path = new_path
+
+    db.set_chunks(file_id, _manifest(path, digests or []))
+    return len(changed), chunks
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """Build the command line parser.
+
+    Returns:
+        The parser of the tool and its subcommands.
+    """
     commander = argparse.ArgumentParser(
         prog="EncryptedDatabase",
         description="Tool to encrypt and manage files",
     )
+    commander.add_argument(
+        "--timings",
+        help="prints a per-phase timing breakdown as JSON to stderr",
+        action="store_true",
+    )
+    commander.add_argument(
+        "--timings-file",
+        help="file where the timing breakdown will be stored as JSON",
+        type=str,
+    )
+    commander.add_argument(
+        "--profile",
+        help="file where cProfile statistics will be stored",
+        type=str,
+    )
+    commander.add_argument(
+        "--socket",
+        help="Unix socket of the daemon that runs the command "
+        "(or the socket serve listens on)",
+        type=str,
+    )
     subcommander = commander.add_subparsers(dest="command")
 
     read = subcommander.add_parser(
         "read", description="decrypts a file from database"
     )
-    read.add_argument(
+    targets = read.add_mutually_exclusive_group(required=True)
+    targets.add_argument(
         "-f",
         "--filename",
         help="name of the file to be decrypted",
-        required=True,
+        type=str,
+    )
+    targets.add_argument(
+        "-a",
+        "--all",
+        help="decrypts all the files of the current user into -o",
+        action="store_true",
+    )
+    targets.add_argument(
+        "-p",
+        "--pattern",
+        help="decrypts the files whose names match a glob pattern into -o",
         type=str,
     )
     read.add_argument(
         "-k",
         "--key",
-        help="private key for decryption",
+        help="private key: (d, n) or (d, n, p, q, dp, dq, qinv)",
         required=True,
         type=str,
     )
     read.add_argument(
         "-o",
         "--output",
-        help="file where the content will be stored",
+        help="file where the content will be stored "
+        "(a directory with --all/--pattern)",
         required=False,
         type=str,
     )
+    read.add_argument(
+        "--offset",
+        help="with -f, the plaintext offset to start decrypting at",
+        default=0,
+        type=int,
+    )
+    read.add_argument(
+        "--length",
+        help="with -f, the number of bytes to decrypt",
+        type=int,
+    )
 
     generate = subcommander.add_parser(
         "generate", description="generates a new key pair"
@@ -100,15 +438,35 @@ if __name__ == "__main__":
         required=False,
         type=str,
     )
+    generate.add_argument(
+        "-p",
+        "--prefill",
+        help="pregenerates key pairs and stores them in the key pool",
+        required=False,
+        type=int,
+    )
 
     encrypt = subcommander.add_parser(
         "encrypt", description="encrypt a file and adds it to the database"
     )
-    encrypt.add_argument(
+    sources = encrypt.add_mutually_exclusive_group(required=True)
+    sources.add_argument(
         "-f",
         "--filepath",
         help="path of the file to be encrypted",
-        required=True,
+        type=str,
+    )
+    sources.add_argument(
+        "-r",
+        "--recursive",
+        help="directory whose files are all encrypted, named by relative path",
+        type=str,
+    )
+    sources.add_argument(
+        "-g",
+        "--glob",
+        help="glob pattern of the files to be encrypted, stored under "
+        "their basename (files with the same basename fail)",
         type=str,
     )
     encrypt.add_argument(
@@ -118,6 +476,36 @@ if __name__ == "__main__":
         required=False,
         type=int,
     )
+    encrypt.add_argument(
+        "--format",
+        help="file format: block RSA or hybrid RSA + stream cipher",
+        required=False,
+        choices=["block", "hybrid"],
+        type=str,
+    )
+    encrypt.add_argument(
+        "-u",
+        "--update",
+        help="replaces the stored file of the same name (with -f), "
+        "re-encrypting only the chunks that changed; files stored with "
+        "-r or -g, or without a digest_secret, have no chunk manifest and "
+        "are encrypted again",
+        action="store_true",
+    )
+    encrypt.add_argument(
+        "--compress",
+        help="compresses the files before encrypting them "
+        "(skipped for data that doesn't compress)",
+        required=False,
+        choices=["none", "zlib", "lzma", "zstd"],
+        type=str,
+    )
+    encrypt.add_argument(
+        "--compression-level",
+        help="compression level (the preset for lzma)",
+        required=False,
+        type=int,
+    )
 
     delete = subcommander.add_parser(
         "delete", description="deletes a file from the database"
@@ -154,6 +542,13 @@ if __name__ == "__main__":
         required=False,
         action="store_true",
     )
+    account.add_argument(
+        "-s",
+        "--settings",
+        help="shows the database settings in effect",
+        action="store_true",
+        required=False,
+    )
     account.add_argument(
         "-o",
         "--output",
@@ -162,113 +557,258 @@ if __name__ == "__main__":
         type=str,
     )
 
-    args = commander.parse_args()
+    subcommander.add_parser(
+        "serve",
+        description="keeps the database and the worker pools open "
+        "and runs the commands sent to --socket",
+    )
+
+    return commander
+
+
+def load_config() -> dict:
+    """Read config.json, which is next to this file.
 
+    Returns:
+        The configuration.
+    """
     abs_path = os.path.abspath(__file__)
     parent_dir = os.path.dirname(abs_path)
 
     json_path = os.path.join(parent_dir, "config.json")
     try:
-        with open(json_path, "r") as fptr:
-            config = json.loads(fptr.read())
+        with timing.phase("config"), open(json_path, "r") as fptr:
+            return json.loads(fptr.read())
     except FileNotFoundError:
         failure("config.json not found", None)
 
+
+def connect(config: dict):
+    """Open the database named in the config.
+
+    Arguments:
+        config: The configuration read by load_config.
+    """
     try:
         db_path = config["db_path"]
     except KeyError as e:
         failure(f"{e} is missing from config.json", None)
 
     try:
-        db.connect(db_path)
+        with timing.phase("db.connect"):
+            db.connect(db_path, config.get("sqlite"))
     except FileNotFoundError:
         failure("database schema not found", None)
+    except ValueError as e:
+        failure(f"invalid sqlite settings in config.json: {e}", None)
     except sqlite3.Error:
         failure("database connection failed", None)
 
-    username = os.getlogin()
-    user = db.get_user_by_username(username)
 
-    if user is None:
-        user_id = db.add_user(username)
-    else:
-        user_id = user[0]
+def start_instrumentation(args):
+    """Enable the timings and the profiling requested on the command line.
+
+    Arguments:
+        args: The parsed command line.
+
+    Returns:
+        The running cProfile.Profile, or None.
+    """
+    if args.timings or args.timings_file is not None:
+        timing.enable()
+    if args.profile is None:
+        return None
+
+    import cProfile
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop_instrumentation(args, profiler):
+    """Save the profile and report the timings of a command.
+
+    Arguments:
+        args: The parsed command line.
+        profiler: The value returned by start_instrumentation.
+    """
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+
+    report = timing.report()
+    timing.disable()
+    if report is not None:
+        if args.timings_file is not None:
+            with open(args.timings_file, "w") as writer:
+                json.dump(report, writer, indent=2)
+        if args.timings:
+            print(json.dumps(report), file=sys.stderr)
+
+
+def run(args, config: dict, username: str):
+    """Run a parsed subcommand on the connected database.
+
+    Arguments:
+        args: The parsed command line.
+        config: The configuration read by load_config.
+        username: The user the command runs for.
+    """
+    with timing.phase("db.user"):
+        user = db.get_user_by_username(username)
+
+        if user is None:
+            user_id = db.add_user(username)
+        else:
+            user_id = user[0]
 
     if args.command == "read":
         filename = args.filename
         key = args.key
         output = args.output
 
-        file = db.get_file_by_filename(user_id, filename)
-        if file is None:
-            failure("file not found", db)
+        try:
+            key = parse_key(key)
+        except ValueError as e:
+            failure(e, db)
 
-        path = file[2]
+        if args.offset < 0 or args.length is not None and args.length < 0:
+            failure("--offset and --length must not be negative", db)
+
+        workers = config.get("workers", 1)
+        buffer_size = config.get("buffer_size", utils.DEFAULT_BUFFER_SIZE)
+        use_mmap = config.get("mmap", False)
+
+        if filename is not None:
+            file = db.get_file_by_filename(user_id, filename)
+            if file is None:
+                failure("file not found", db)
+
+            path = file[2]
 
-        key.strip("()")
-        regex = r"(\S+)[, ]+(\S+)"
-        match = re.match(regex, key)
-        if match:
-            key = (match.group(1), match.group(2))
+            try:
+                compress.decrypt_file(
+                    path,
+                    output,
+                    key,
+                    workers=workers,
+                    buffer_size=buffer_size,
+                    use_mmap=use_mmap,
+                    offset=args.offset,
+                    length=args.length,
+                )
+            except FileNotFoundError:
+                failure(f"{path} not found", db)
+            except ValueError as e:
+                failure(e, db)
         else:
-            failure("invalid key format", db)
+            if output is None:
+                failure("provide an output directory with -o", db)
 
-        d = int.from_bytes(base64.b64decode(key[0]), byteorder=sys.byteorder)
-        n = int.from_bytes(base64.b64decode(key[1]), byteorder=sys.byteorder)
-        key = (d, n)
-        try:
-            rsa.decrypt_file(path, output, key)
-        except FileNotFoundError:
-            failure(f"{path} not found", db)
+            if args.all:
+                files = db.get_files_by_user_id(user_id)
+            else:
+                files = db.get_files_by_pattern(user_id, args.pattern)
+
+            jobs = [(file[2], os.path.join(output, file[1])) for file in files]
+
+            import scrypt.batch as batch
+
+            decrypted = 0
+            failed = 0
+            results = batch.decrypt_files(
+                jobs, key, workers, buffer_size, use_mmap
+            )
+            for (path, _), error in results:
+                if error is not None:
+                    failed += 1
+                    print(f"{path}: {error}")
+                else:
+                    decrypted += 1
+
+            print(f"{decrypted} files decrypted, {failed} failed")
     elif args.command == "generate":
         try:
             key_len = config["key_length"]
         except KeyError as e:
-            failure(f"{e} is missing from config.json")
+            failure(f"{e} is missing from config.json", db)
 
-        public_key, private_key = rsa.key_gen(key_len)
-        public_key = utils.base64_tuple(public_key)
-        private_key = utils.base64_tuple(private_key)
+        pool_secret = config.get("key_pool_secret")
+        if pool_secret is not None:
+            import scrypt.keypool as keypool
 
-        key_id = db.add_key(user_id, public_key[0], public_key[1])
-        if args.default:
-            db.update_user(key_id, user_id)
+        if args.prefill is not None:
+            if pool_secret is None:
+                failure("key_pool_secret is missing from config.json", db)
 
-        e = public_key[0].decode("ascii")
-        d = private_key[0].decode("ascii")
-        n = private_key[1].decode("ascii")
+            pool_key = keypool.derive_pool_key(pool_secret)
+            key_pairs = keypool.generate_key_pairs(
+                args.prefill, key_len, config.get("workers", 1)
+            )
+            db.add_pooled_keys(
+                key_len,
+                [keypool.seal_key_pair(x, pool_key) for x in key_pairs],
+            )
+            print(f"{db.count_pooled_keys(key_len)} key pairs in the pool")
+        else:
+            key_pair = None
+            if pool_secret is not None:
+                sealed = db.pop_pooled_key(key_len)
+                if sealed is not None:
+                    try:
+                        key_pair = keypool.unseal_key_pair(
+                            sealed, keypool.derive_pool_key(pool_secret)
+                        )
+                    except ValueError:
+                        failure("pooled key pair can't be unsealed", db)
 
-        key_pair = f"({e}, {n})\n({d}, {n})"
+            if key_pair is None:
+                key_pair = rsa.key_gen(key_len)
 
-        if args.output is not None:
-            with open(args.output, "w+") as writer:
-                writer.write(key_pair)
-        else:
-            print(key_pair)
+            public_key = utils.base64_tuple(key_pair[0])
+            private_key = utils.base64_tuple(key_pair[1])
+
+            key_id = db.add_key(user_id, *key_pair[0])
+            if args.default:
+                db.update_user(key_id, user_id)
+
+            e = public_key[0].decode("ascii")
+            n = public_key[1].decode("ascii")
+            private_key = ", ".join(x.decode("ascii") for x in private_key)
+
+            key_pair = f"({e}, {n})\n({private_key})"
+
+            if args.output is not None:
+                with open(args.output, "w+") as writer:
+                    writer.write(key_pair)
+            else:
+                print(key_pair)
     elif args.command == "encrypt":
         try:
             encrypted_path = config["encrypted_path"]
         except Exception as e:
-            failure(f"{e} is missing from config.json")
+            failure(f"{e} is missing from config.json", db)
 
         filepath = args.filepath
         key = args.key
 
+        file = None
+        if args.update and filepath is not None:
+            filename = os.path.basename(filepath)
+            file = db.get_file_by_filename(user_id, filename)
+            if file is not None and key is None:
+                key = file[3]
+
         if key is None:
-            key = db.get_current_key_for_user(user_id)
-            if key is None:
-                failure("provide a key id or set a default one", db)
+            key = db.get_current_public_key(user_id)
         else:
-            key = db.get_key_by_key_id(key)
-            if key is None:
-                failure("provide a key id or set a default one", db)
-
-        key_id = key[0]
-        e = int.from_bytes(base64.b64decode(key[2]), byteorder=sys.byteorder)
-        n = int.from_bytes(base64.b64decode(key[3]), byteorder=sys.byteorder)
-        key = (e, n)
+            public_key = db.get_public_key(key)
+            key = None if public_key is None else (key, public_key)
+        if key is None:
+            failure("provide a key id or set a default one", db)
 
-        filename = os.path.basename(filepath)
+        key_id, key = key
 
         if not os.path.exists(encrypted_path):
             failure(f"{encrypted_path} doesn't exist", db)
@@ -276,33 +816,240 @@ if __name__ == "__main__":
         dir_path = os.path.join(encrypted_path, username)
         if not os.path.exists(dir_path):
             os.mkdir(dir_path)
-        
-        encrypted_file_path = os.path.join(dir_path, filename)
-        if os.path.exists(encrypted_file_path):
-            failure("filename already exists in the db", db)
-
-        rsa.encrypt_file(
-            filepath,
-            encrypted_file_path,
-            key,
-        )
-        db.add_file(
-            filename,
-            encrypted_file_path,
-            key_id,
-            user_id,
-        )
+
+        file_format = args.format or config.get("file_format", "block")
+        if file is not None and args.format is None:
+            file_format = compress.file_info(file[2])[0]
+        if args.compress is not None:
+            compression = None if args.compress == "none" else args.compress
+            config = dict(config, compression=compression)
+        if args.compression_level is not None:
+            config = dict(config, compression_level=args.compression_level)
+        workers = config.get("workers", 1)
+        buffer_size = config.get("buffer_size", utils.DEFAULT_BUFFER_SIZE)
+        use_mmap = config.get("mmap", False)
+        # identical content is only found through keyed digests
+        secret = config.get("digest_secret")
+        dedup = config.get("dedup", True) and secret is not None
+        digest_key = None if secret is None else utils.digest_key(secret, key)
+
+        if file is not None:
+            try:
+                changed, chunks = reencrypt(
+                    file,
+                    filepath,
+                    dir_path,
+                    key_id,
+                    key,
+                    digest_key,
+                    file_format,
+                    config,
+                )
+            except ValueError as e:
+                failure(e, db)
+            print(f"{changed} of {chunks} chunks re-encrypted")
+        elif filepath is not None:
+            filename = os.path.basename(filepath)
+            encrypted_file_path = os.path.join(dir_path, filename)
+            output_path = encrypted_file_path
+            content = None
+            if db.get_file_by_filename(user_id, filename) is not None:
+                failure("filename already exists in the db", db)
+
+            # a ciphertext without a record is left over from a failed run
+            # and is overwritten; a deduplicated one is written aside and
+            # only moved into place once it is recorded
+            # the chunk digests of block files are computed along with
+            # the digest, for the manifest
+            digests = []
+            if digest_key is not None and file_format == "block":
+                digest, digests = utils.file_digests(
+                    filepath, digest_key, rsa.chunk_size(key)
+                )
+            elif dedup:
+                digest = utils.file_digest(filepath, digest_key)
+            if dedup:
+                content = db.get_content(key_id, digest)
+                encrypted_file_path = utils.object_path(
+                    dir_path, key_id, digest
+                )
+                output_path = utils.temp_path(encrypted_file_path)
+                os.makedirs(
+                    os.path.dirname(encrypted_file_path), exist_ok=True
+                )
+
+            if content is not None:
+                with db.transaction():
+                    db.reference_content(content[0])
+                    db.add_file(filename, content[3], key_id, user_id)
+                return
+
+            try:
+                algorithm = encrypt_file(
+                    filepath, output_path, key, file_format, config
+                )
+
+                manifest = digests if algorithm is None else []
+                with db.transaction():
+                    if dedup:
+                        _, encrypted_file_path, created = db.add_content(
+                            key_id, digest, encrypted_file_path
+                        )
+                        if created:
+                            os.replace(output_path, encrypted_file_path)
+                    file_id = db.add_file(
+                        filename,
+                        encrypted_file_path,
+                        key_id,
+                        user_id,
+                    )
+                    db.set_chunks(file_id, manifest)
+            except ValueError as e:
+                failure(e, db)
+            finally:
+                # left over by a failure, or the content was recorded by
+                # another process in the meantime
+                if dedup and os.path.exists(output_path):
+                    os.remove(output_path)
+        else:
+            if args.recursive is not None:
+                sources = []
+                for root, _, names in os.walk(args.recursive):
+                    for name in names:
+                        path = os.path.join(root, name)
+                        filename = os.path.relpath(path, args.recursive)
+                        sources.append((filename, path))
+            else:
+                import glob
+
+                sources = [
+                    (os.path.basename(path), path)
+                    for path in glob.glob(args.glob, recursive=True)
+                    if os.path.isfile(path)
+                ]
+
+            existing = set(db.get_file_names_by_user_id(user_id))
+            jobs = []
+            # output path -> (digest or None, encrypted path, names stored
+            # under it); deduplicated content is written to a temporary
+            # path and moved to the encrypted path once it is recorded
+            targets = {}
+            reused = []
+            # digest -> output path, for the content encrypted by this run
+            pending = {}
+            # filename -> source path, for the files of this run
+            batch_sources = {}
+            skipped = 0
+            failed = 0
+            for filename, path in sorted(sources):
+                # only the db says whether a file is stored: a ciphertext
+                # without a record is left over and is overwritten
+                encrypted_file_path = os.path.join(dir_path, filename)
+                if filename in batch_sources:
+                    failed += 1
+                    print(
+                        f"{path}: same filename as {batch_sources[filename]}"
+                    )
+                    continue
+                if filename in existing:
+                    skipped += 1
+                    continue
+
+                batch_sources[filename] = path
+                if not dedup:
+                    targets[encrypted_file_path] = (
+                        None,
+                        encrypted_file_path,
+                        [filename],
+                    )
+                    jobs.append((path, encrypted_file_path))
+                    continue
+
+                digest = utils.file_digest(path, digest_key)
+                content = db.get_content(key_id, digest)
+                if content is not None:
+                    reused.append((content[0], filename, content[3]))
+                    continue
+
+                if digest in pending:
+                    targets[pending[digest]][2].append(filename)
+                    continue
+
+                encrypted_file_path = utils.object_path(
+                    dir_path, key_id, digest
+                )
+                output_path = utils.temp_path(encrypted_file_path)
+                pending[digest] = output_path
+                targets[output_path] = (
+                    digest,
+                    encrypted_file_path,
+                    [filename],
+                )
+                jobs.append((path, output_path))
+
+            with db.transaction():
+                for content_id, _, _ in reused:
+                    db.reference_content(content_id)
+                db.add_files(
+                    [(name, path, key_id, user_id) for _, name, path in reused]
+                )
+
+            import scrypt.batch as batch
+
+            files = []
+            # (output path, digest, encrypted path, number of names)
+            contents = []
+            encrypted = len(reused)
+            deduplicated = len(reused)
+            results = batch.encrypt_files(
+                jobs,
+                key,
+                workers,
+                file_format,
+                buffer_size,
+                use_mmap,
+                config.get("compression"),
+                config.get("compression_level"),
+            )
+            for (path, output_path), error in results:
+                digest, encrypted_file_path, names = targets[output_path]
+                if error is not None:
+                    failed += len(names)
+                    print(f"{path}: {error}")
+                    continue
+
+                if digest is not None:
+                    contents.append(
+                        (output_path, digest, encrypted_file_path, names)
+                    )
+                else:
+                    files.append(
+                        (names[0], encrypted_file_path, key_id, user_id)
+                    )
+                encrypted += len(names)
+                deduplicated += len(names) - 1
+                if len(files) + len(contents) >= DB_BATCH_SIZE:
+                    _add_batch(contents, files, key_id, user_id)
+
+            _add_batch(contents, files, key_id, user_id)
+            print(
+                f"{encrypted} files encrypted ({deduplicated} deduplicated), "
+                f"{skipped} skipped, {failed} failed"
+            )
     elif args.command == "delete":
         filename = args.filename
         file = db.get_file_by_filename(user_id, filename)
         if file is None:
             failure("file not found", db)
 
-        db.delete_file(user_id, filename)
         path = file[2]
+        with db.transaction():
+            db.delete_file(user_id, filename)
+            unused = db.release_content(path)
 
         try:
-            os.remove(path)
+            if unused:
+                os.remove(path)
         except OSError:
             failure(f"File located at {path} can't be removed", db)
     elif args.command == "account":
@@ -320,27 +1067,264 @@ if __name__ == "__main__":
         if args.keys:
             keys = db.get_keys_by_user_id(user_id)
             for key in keys:
-                file_print(f"id: {key[0]}, e: {key[2]}, n: {key[3]}", output)
+                e, n = (base64.b64encode(x).decode("ascii") for x in key[2:4])
+                file_print(f"id: {key[0]}, e: {e}, n: {n}", output)
+
+        if args.settings:
+            for name, value in db.settings().items():
+                file_print(f"{name}: {value}", output)
 
         if args.default is not None:
             key_id = args.default
-            key = db.get_key_by_key_id(key_id)
-            if key is None:
+            if not db.has_key(key_id):
                 failure(f"key {key_id} wasn't found in the db", db)
             db.update_user(key_id, user_id)
 
         if args.erase:
-            files = db.get_files_by_user_id(user_id)
+            paths = db.get_file_paths_by_user_id(user_id)
 
-            for file in files:
-                path = file[2]
+            # the files are only removed once the account is gone
+            with db.transaction():
+                unused = [path for path in paths if db.release_content(path)]
+                db.delete_user(user_id)
+
+            for path in unused:
                 try:
                     os.remove(path)
                 except OSError:
                     failure(f"File located at {path} can't be removed", db)
-            
-            db.delete_user(user_id)
-    else:
+
+
+def _read_request(conn, data: bytes) -> dict:
+    """Read the JSON request sent by a client of the daemon.
+
+    Arguments:
+        conn: The accepted client socket.
+        data: What was received with the client's file descriptors:
+            the length of the request and its first bytes.
+
+    Returns:
+        The request.
+
+    Raises:
+        ValueError: if the request is truncated or malformed.
+    """
+    size = int.from_bytes(data[:4], byteorder="big")
+    data = data[4:]
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise ValueError("truncated request")
+        data += chunk
+
+    request = json.loads(data)
+    if not isinstance(request, dict) or not isinstance(
+        request.get("argv"), list
+    ):
+        raise ValueError("malformed request")
+
+    return request
+
+
+def _handle(conn, commander, config: dict):
+    """Run one request received by the daemon.
+
+    The client sends the length of a JSON request (argv, cwd, username)
+    along with its stdout and stderr, which the command writes to
+    directly. The daemon answers with the exit status.
+
+    Arguments:
+        conn: The accepted client socket.
+        commander: The parser built by build_parser.
+        config: The configuration read by load_config.
+    """
+    import socket
+    import struct
+
+    credentials = conn.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+    )
+    if struct.unpack("3i", credentials)[1] != os.getuid():
+        return
+
+    data, fds, _, _ = socket.recv_fds(conn, 1 << 16, 2)
+    if len(fds) != 2 or len(data) < 4:
+        for fd in fds:
+            os.close(fd)
+        return
+
+    status = 0
+    cwd = os.getcwd()
+    with open(fds[0], "w") as out, open(fds[1], "w") as err:
+        try:
+            request = _read_request(conn, data)
+            with redirect_stdout(out), redirect_stderr(err):
+                os.chdir(request["cwd"])
+                args = commander.parse_args(request["argv"])
+                if args.command in (None, "serve"):
+                    commander.print_help()
+                else:
+                    if not db.is_connected():
+                        connect(config)
+                    profiler = start_instrumentation(args)
+                    run(args, config, request["username"])
+                    stop_instrumentation(args, profiler)
+        except SystemExit as e:
+            if isinstance(e.code, int):
+                status = e.code
+            elif e.code is not None:
+                print(e.code, file=err)
+                status = 1
+        except Exception as e:
+            print(f"error: {e}", file=err)
+            status = 1
+        finally:
+            os.chdir(cwd)
+            timing.disable()
+
+    conn.sendall(status.to_bytes(4, byteorder="big", signed=True))
+
+
+def serve(socket_path: str, config: dict):
+    """Serve requests on a Unix socket until interrupted.
+
+    The database connection, the parsed keys and the worker pools are
+    kept between requests, which run one at a time. Only processes of
+    the same system user may connect.
+
+    Arguments:
+        socket_path: The path of the socket to listen on.
+        config: The configuration read by load_config.
+    """
+    import signal
+    import socket
+
+    if os.path.exists(socket_path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(socket_path)
+            except ConnectionRefusedError:
+                os.remove(socket_path)
+            else:
+                failure(f"a daemon already listens on {socket_path}", None)
+
+    connect(config)
+    utils.keep_worker_pools()
+    commander = build_parser()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(umask)
+    server.listen()
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    print(f"listening on {socket_path}", flush=True)
+
+    try:
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                try:
+                    _handle(conn, commander, config)
+                except Exception as e:
+                    # a bad request fails alone, the daemon keeps serving
+                    print(f"request failed: {e}", file=sys.stderr)
+                    try:
+                        conn.sendall((1).to_bytes(4, byteorder="big"))
+                    except OSError:
+                        pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.remove(socket_path)
+        utils.keep_worker_pools(False)
+        if db.is_connected():
+            db.disconnect()
+
+
+def forward(socket_path: str, argv: list[str]) -> int | None:
+    """Run a command on the daemon listening on a socket.
+
+    Arguments:
+        socket_path: The path of the daemon's socket.
+        argv: The command line arguments, without the program name.
+
+    Returns:
+        The exit status of the command, or None if no daemon is listening.
+    """
+    import socket
+
+    request = json.dumps(
+        {"argv": argv, "cwd": os.getcwd(), "username": os.getlogin()}
+    ).encode("utf-8")
+    data = len(request).to_bytes(4, byteorder="big") + request
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(socket_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        sent = socket.send_fds(
+            client, [data], [sys.stdout.fileno(), sys.stderr.fileno()]
+        )
+        if sent < len(data):
+            client.sendall(data[sent:])
+
+        status = b""
+        while len(status) < 4:
+            chunk = client.recv(4 - len(status))
+            if not chunk:
+                failure("the daemon closed the connection", None)
+            status += chunk
+
+    return int.from_bytes(status, byteorder="big", signed=True)
+
+
+def main(argv=None) -> int:
+    """Run the command line tool.
+
+    Arguments:
+        argv: The command line arguments, or None for sys.argv[1:].
+
+    Returns:
+        The exit status.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+
+    commander = build_parser()
+    args = commander.parse_args(argv)
+    if args.command is None:
         commander.print_help()
+        return 0
+
+    profiler = start_instrumentation(args)
+    config = load_config()
+    socket_path = args.socket or config.get("socket")
+
+    if args.command == "serve":
+        if socket_path is None:
+            failure("provide a socket path with --socket or in config", None)
+        serve(socket_path, config)
+        return 0
 
+    if socket_path is not None:
+        status = forward(socket_path, argv)
+        if status is not None:
+            return status
+
+    connect(config)
+    run(args, config, os.getlogin())
     db.disconnect()
+    stop_instrumentation(args, profiler)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
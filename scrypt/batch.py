@@ -0,0 +1,220 @@
+"""This module encrypts and decrypts many files concurrently.
+
+Every file is handled by one worker process, so a batch uses all the
+configured cores while each file is still processed sequentially.
+
+Functions:
+    encrypt_one(path_src: str, path_dest: str, public_key: tuple[int,
+        int], file_format: str, buffer_size, use_mmap: bool,
+        compression=None, compression_level=None):
+        Encrypt one file, removing the partial output if it fails.
+    decrypt_one(path_src: str, path_dest: str, private_key: tuple[int,
+        ...], buffer_size, use_mmap: bool, offset: int = 0, length=None):
+        Decrypt one file, or a byte range of it.
+    encrypt_files(jobs: list[tuple[str, str]], public_key: tuple[int, int],
+        workers: int, file_format="block", buffer_size=None,
+        use_mmap=False, compression=None, compression_level=None):
+        Encrypt many files on a pool of worker processes.
+    decrypt_files(jobs: list[tuple[str, str]], private_key: tuple[int, ...],
+        workers: int, buffer_size=None, use_mmap=False):
+        Decrypt many files on a pool of worker processes.
+"""
+
+import os
+from functools import partial
+import scrypt.compress as compress
+import scrypt.utils as utils
+
+# the errors of one file; any other error aborts the batch
+JOB_ERRORS = (OSError, ValueError)
+
+
+def encrypt_one(
+    path_src: str,
+    path_dest: str,
+    public_key: tuple[int, int],
+    file_format: str,
+    buffer_size,
+    use_mmap: bool,
+    compression=None,
+    compression_level=None,
+):
+    """Encrypt one file, removing the partial output if it fails.
+
+    Arguments:
+        path_src: The path to the source file to be encrypted.
+        path_dest: The path to save the encrypted file.
+        public_key: The public key (e, n) for RSA encryption.
+        file_format: "block" or "hybrid".
+        buffer_size: The I/O buffer size for block files.
+        use_mmap: Whether to memory-map block files.
+        compression: The compression algorithm, or None.
+        compression_level: The compression level, or None.
+    """
+    os.makedirs(os.path.dirname(path_dest), exist_ok=True)
+    try:
+        compress.encrypt_file(
+            path_src,
+            path_dest,
+            public_key,
+            file_format,
+            compression,
+            compression_level,
+            buffer_size=buffer_size,
+            use_mmap=use_mmap,
+        )
+    except BaseException:
+        if os.path.exists(path_dest):
+            os.remove(path_dest)
+        raise
+
+
+def decrypt_one(
+    path_src: str,
+    path_dest: str,
+    private_key: tuple[int, ...],
+    buffer_size,
+    use_mmap: bool,
+    offset: int = 0,
+    length=None,
+):
+    """Decrypt one file, or a byte range of it.
+
+    Arguments:
+        path_src: The path to the encrypted source file.
+        path_dest: The path to save the decrypted file.
+        private_key: The private key (d, n) or (d, n, p, q, dp, dq, qinv).
+        buffer_size: The I/O buffer size for block files.
+        use_mmap: Whether to memory-map block files.
+        offset: The plaintext offset to start decrypting at.
+        length: The number of bytes to decrypt, or None for all of them.
+    """
+    dir_path = os.path.dirname(path_dest)
+    if dir_path:
+        os.makedirs(dir_path, exist_ok=True)
+
+    compress.decrypt_file(
+        path_src,
+        path_dest,
+        private_key,
+        buffer_size=buffer_size,
+        use_mmap=use_mmap,
+        offset=offset,
+        length=length,
+    )
+
+
+def _run(func, jobs, workers: int):
+    """Apply func to every job, yielding each job with its outcome.
+
+    At most four jobs per worker are queued at a time. Only JOB_ERRORS
+    are reported per job, whether the job ran in this process or in a
+    worker; any other error is raised.
+
+    Arguments:
+        func: A picklable function taking the elements of a job.
+        jobs: An iterable of argument tuples.
+        workers: The number of worker processes; 1 runs in this process.
+
+    Yields:
+        (job, error) tuples, where error is None on success.
+    """
+    if workers <= 1:
+        for job in jobs:
+            try:
+                func(*job)
+            except JOB_ERRORS as e:
+                yield job, e
+            else:
+                yield job, None
+        return
+
+    from concurrent.futures import FIRST_COMPLETED, wait
+
+    jobs = iter(jobs)
+    with utils.worker_pool(workers) as executor:
+        pending = {}
+        while True:
+            for job in jobs:
+                pending[executor.submit(func, *job)] = job
+                if len(pending) >= 4 * workers:
+                    break
+
+            if not pending:
+                return
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                error = future.exception()
+                if error is not None and not isinstance(error, JOB_ERRORS):
+                    raise error
+                yield pending.pop(future), error
+
+
+def encrypt_files(
+    jobs: list[tuple[str, str]],
+    public_key: tuple[int, int],
+    workers: int,
+    file_format="block",
+    buffer_size=None,
+    use_mmap=False,
+    compression=None,
+    compression_level=None,
+):
+    """Encrypt many files on a pool of worker processes.
+
+    Arguments:
+        jobs: (path_src, path_dest) pairs; missing destination
+            directories are created.
+        public_key: The public key (e, n) for RSA encryption.
+        workers: The number of worker processes.
+        file_format: "block" or "hybrid".
+        buffer_size: The I/O buffer size for block files.
+        use_mmap: Whether to memory-map block files.
+        compression: The compression algorithm, or None.
+        compression_level: The compression level, or None.
+
+    Yields:
+        ((path_src, path_dest), error) tuples in completion order, where
+        error is None if the file was encrypted.
+    """
+    func = partial(
+        encrypt_one,
+        public_key=public_key,
+        file_format=file_format,
+        buffer_size=buffer_size,
+        use_mmap=use_mmap,
+        compression=compression,
+        compression_level=compression_level,
+    )
+    yield from _run(func, jobs, workers)
+
+
+def decrypt_files(
+    jobs: list[tuple[str, str]],
+    private_key: tuple[int, ...],
+    workers: int,
+    buffer_size=None,
+    use_mmap=False,
+):
+    """Decrypt many files on a pool of worker processes.
+
+    Arguments:
+        jobs: (path_src, path_dest) pairs; missing destination
+            directories are created.
+        private_key: The private key (d, n) or (d, n, p, q, dp, dq, qinv).
+        workers: The number of worker processes.
+        buffer_size: The I/O buffer size for block files.
+        use_mmap: Whether to memory-map block files.
+
+    Yields:
+        ((path_src, path_dest), error) tuples in completion order, where
+        error is None if the file was decrypted.
+    """
+    func = partial(
+        decrypt_one,
+        private_key=private_key,
+        buffer_size=buffer_size,
+        use_mmap=use_mmap,
+    )
+    yield from _run(func, jobs, workers)
@@ -0,0 +1,471 @@
+"""This module adds an optional compression stage to file encryption.
+
+The source is compressed while it is read and the compressed stream is
+encrypted in the block or hybrid format behind a small header naming the
+algorithm, so memory use does not depend on the file size. A sample of
+the source is compressed first; data that doesn't shrink is encrypted as
+is, without the header. decrypt_file and decrypt_stream read all three
+kinds of files and decompress transparently.
+
+File layout:
+    MAGIC (4 bytes) | algorithm id (1 byte) | block or hybrid file
+
+Functions:
+    available() -> list[str]: Return the compression algorithms installed.
+    file_info(path: str) -> tuple[str, str | None]:
+        Return the format and the compression algorithm of a file.
+    encrypt_file(path_src: str, path_dest: str, public_key: tuple[int,
+        int], file_format="block", algorithm=None, level=None, workers=1,
+        buffer_size=None, use_mmap=False) -> str | None:
+        Encrypt a file, compressing it first if it is worth it.
+    decrypt_file(path_src: str, path_dest: str, private_key: tuple[int,
+        ...], workers=1, buffer_size=None, use_mmap=False, offset=0,
+        length=None):
+        Decrypt a file, or a byte range of it, and decompress it.
+    decrypt_stream(path_src: str, dest, private_key: tuple[int, ...],
+        workers=1, buffer_size=None, use_mmap=False, offset=0,
+        length=None):
+        Decrypt a file, or a byte range of it, into a file-like object.
+"""
+
+import os
+import sys
+from functools import cache
+import scrypt.hybrid as hybrid
+import scrypt.rsa as rsa
+
+MAGIC = b"EDB\x03"
+
+ALGORITHMS = {"zlib": 1, "lzma": 2, "zstd": 3}
+
+SAMPLE_SIZE = 1 << 16
+MAX_RATIO = 0.9
+READ_SIZE = 1 << 20
+
+
+@cache
+def _zstandard():
+    """Import zstandard on first use.
+
+    Returns:
+        The zstandard module, or None if it is not installed.
+    """
+    try:
+        import zstandard
+    except ImportError:
+        return None
+
+    return zstandard
+
+
+def available() -> list[str]:
+    """Return the compression algorithms installed.
+
+    Returns:
+        The names of the algorithms, zstd only if zstandard is installed.
+    """
+    return [
+        name
+        for name in ALGORITHMS
+        if name != "zstd" or _zstandard() is not None
+    ]
+
+
+def _compressor(algorithm: str, level):
+    """Create a compressor with compress() and flush() methods.
+
+    Arguments:
+        algorithm: "zlib", "lzma" or "zstd".
+        level: The compression level (the preset for lzma), or None for
+            the default of the algorithm.
+
+    Raises:
+        ValueError: if the algorithm is unknown or not installed.
+    """
+    if algorithm == "zlib":
+        import zlib
+
+        return zlib.compressobj(-1 if level is None else level)
+    if algorithm == "lzma":
+        import lzma
+
+        return lzma.LZMACompressor(preset=level)
+    if algorithm == "zstd":
+        zstandard = _zstandard()
+        if zstandard is None:
+            raise ValueError("the zstandard package is required")
+        return zstandard.ZstdCompressor(
+            level=3 if level is None else level
+        ).compressobj()
+
+    raise ValueError(f"unknown compression algorithm {algorithm}")
+
+
+def _decompress(algorithm_id: int):
+    """Create a streaming decompression function.
+
+    Arguments:
+        algorithm_id: One of the ALGORITHMS ids.
+
+    Returns:
+        A tuple (decompress, finished): decompress maps a piece of the
+        compressed stream to an iterator of output pieces of at most
+        READ_SIZE bytes (zstd pieces are not capped), and finished
+        tells whether the end of the stream was reached.
+
+    Raises:
+        ValueError: if the algorithm is unknown or not installed.
+    """
+    if algorithm_id == ALGORITHMS["zlib"]:
+        import zlib
+
+        decompressor = zlib.decompressobj()
+
+        def decompress(data):
+            while True:
+                output = decompressor.decompress(data, READ_SIZE)
+                if output:
+                    yield output
+                data = decompressor.unconsumed_tail
+                if not data and len(output) < READ_SIZE:
+                    return
+
+    elif algorithm_id == ALGORITHMS["lzma"]:
+        import lzma
+
+        decompressor = lzma.LZMADecompressor()
+
+        def decompress(data):
+            while True:
+                output = decompressor.decompress(data, READ_SIZE)
+                if output:
+                    yield output
+                data = b""
+                if decompressor.eof or decompressor.needs_input:
+                    return
+
+    elif algorithm_id == ALGORITHMS["zstd"]:
+        zstandard = _zstandard()
+        if zstandard is None:
+            raise ValueError("the zstandard package is required")
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+
+        def decompress(data):
+            yield decompressor.decompress(data)
+
+    else:
+        raise ValueError(f"unknown compression algorithm id {algorithm_id}")
+
+    return decompress, lambda: decompressor.eof
+
+
+class _CompressedReader:
+    """A readable file that compresses another file as it is read."""
+
+    def __init__(self, src, compressor):
+        """Wrap a file.
+
+        Arguments:
+            src: The file to compress.
+            compressor: The compressor created by _compressor.
+        """
+        self.src = src
+        self.compressor = compressor
+        self.buffer = bytearray()
+        self.eof = False
+
+    def read(self, size: int) -> bytes:
+        """Read size bytes of the compressed stream, fewer at its end."""
+        while len(self.buffer) < size and not self.eof:
+            data = self.src.read(READ_SIZE)
+            if data:
+                self.buffer += self.compressor.compress(data)
+            else:
+                self.buffer += self.compressor.flush()
+                self.eof = True
+
+        result = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return result
+
+
+class _Done(Exception):
+    """Raised by _DecompressedWriter once the requested range is out."""
+
+
+class _DecompressedWriter:
+    """A writable file that decompresses what is written to it.
+
+    The output before offset is dropped, and _Done is raised once length
+    bytes have been written, so a range read stops early.
+    """
+
+    def __init__(self, dest, algorithm_id: int, offset=0, length=None):
+        """Wrap a file.
+
+        Arguments:
+            dest: The file to write the decompressed stream to.
+            algorithm_id: One of the ALGORITHMS ids.
+            offset: The number of decompressed bytes to drop.
+            length: The number of bytes to write, or None for all.
+        """
+        self.dest = dest
+        self.decompress, self.finished = _decompress(algorithm_id)
+        self.skip = offset
+        self.remaining = length
+
+    def write(self, data) -> int:
+        """Decompress a piece of the stream into the destination."""
+        if self.remaining == 0:
+            raise _Done()
+
+        for output in self.decompress(data):
+            if self.skip:
+                dropped = min(self.skip, len(output))
+                output = output[dropped:]
+                self.skip -= dropped
+            if self.remaining is not None:
+                output = output[:self.remaining]
+                self.remaining -= len(output)
+            self.dest.write(output)
+            if self.remaining == 0:
+                raise _Done()
+
+        return len(data)
+
+    def flush(self):
+        """Flush the destination."""
+        self.dest.flush()
+
+
+def file_info(path: str) -> tuple[str, str | None]:
+    """Return the format and the compression algorithm of a file.
+
+    Arguments:
+        path: The path of an encrypted file.
+
+    Returns:
+        A tuple ("block" or "hybrid", algorithm name or None).
+    """
+    with open(path, "rb") as reader:
+        header = reader.read(len(MAGIC) + 1)
+        algorithm = None
+        if header[:len(MAGIC)] == MAGIC and len(header) > len(MAGIC):
+            algorithm = next(
+                (
+                    name
+                    for name, algorithm_id in ALGORITHMS.items()
+                    if algorithm_id == header[-1]
+                ),
+                None,
+            )
+            if algorithm is not None:
+                header = reader.read(len(hybrid.MAGIC))
+
+    file_format = "hybrid" if header[:4] == hybrid.MAGIC else "block"
+    return file_format, algorithm
+
+
+def _worth_compressing(src, algorithm: str, level) -> bool:
+    """Compress a sample of a file to see whether it shrinks.
+
+    Arguments:
+        src: The file, positioned at its start; it is rewound.
+        algorithm: The compression algorithm.
+        level: The compression level.
+
+    Returns:
+        True if the sample compresses below MAX_RATIO of its size.
+    """
+    sample = src.read(SAMPLE_SIZE)
+    src.seek(0)
+    if not sample:
+        return False
+
+    compressor = _compressor(algorithm, level)
+    compressed = len(compressor.compress(sample)) + len(compressor.flush())
+    return compressed <= MAX_RATIO * len(sample)
+
+
+def encrypt_file(
+    path_src: str,
+    path_dest: str,
+    public_key: tuple[int, int],
+    file_format="block",
+    algorithm=None,
+    level=None,
+    workers=1,
+    buffer_size=None,
+    use_mmap=False,
+) -> str | None:
+    """Encrypt a file, compressing it first if it is worth it.
+
+    Arguments:
+        path_src: The path to the source file to be encrypted.
+        path_dest: The path to save the encrypted file.
+        public_key: The public key (e, n).
+        file_format: "block" or "hybrid".
+        algorithm: "zlib", "lzma", "zstd", or None not to compress.
+        level: The compression level, or None for the default.
+        workers: The number of processes used to encrypt blocks.
+        buffer_size: The I/O buffer size for block files.
+        use_mmap: Whether to memory-map uncompressed block files.
+
+    Returns:
+        The algorithm the file was compressed with, or None.
+
+    Raises:
+        ValueError: if the key is too short for the format, or the
+            algorithm is unknown or not installed.
+    """
+    if algorithm is not None:
+        compressor = _compressor(algorithm, level)
+        with open(path_src, "rb") as src:
+            if _worth_compressing(src, algorithm, level):
+                with open(path_dest, "wb+") as dest:
+                    dest.write(MAGIC + bytes([ALGORITHMS[algorithm]]))
+                    reader = _CompressedReader(src, compressor)
+                    if file_format == "hybrid":
+                        hybrid.encrypt_stream(reader, dest, public_key)
+                    else:
+                        rsa.encrypt_stream(
+                            reader, dest, public_key, workers, buffer_size
+                        )
+                return algorithm
+
+    if file_format == "hybrid":
+        hybrid.encrypt_file(path_src, path_dest, public_key)
+    else:
+        rsa.encrypt_file(
+            path_src,
+            path_dest,
+            public_key,
+            workers=workers,
+            buffer_size=buffer_size,
+            use_mmap=use_mmap,
+        )
+
+    return None
+
+
+def decrypt_file(
+    path_src: str,
+    path_dest: str,
+    private_key: tuple[int, ...],
+    workers=1,
+    buffer_size=None,
+    use_mmap=False,
+    offset=0,
+    length=None,
+):
+    """Decrypt a file, or a byte range of it, and decompress it.
+
+    The output is removed if decryption fails.
+
+    Arguments:
+        path_src: The path to the encrypted source file.
+        path_dest: The path to save the decrypted file, or None for stdout.
+        private_key: The private key (d, n) or (d, n, p, q, dp, dq, qinv).
+        workers: The number of processes used to decrypt blocks.
+        buffer_size: The I/O buffer size for block files.
+        use_mmap: Whether to memory-map uncompressed block files.
+        offset: The plaintext offset to start decrypting at.
+        length: The number of bytes to decrypt, or None for all of them.
+
+    Raises:
+        ValueError: if the file is damaged or was compressed with an
+            algorithm that is not installed.
+    """
+    options = dict(
+        workers=workers,
+        buffer_size=buffer_size,
+        use_mmap=use_mmap,
+        offset=offset,
+        length=length,
+    )
+    if path_dest is None:
+        decrypt_stream(path_src, sys.stdout.buffer, private_key, **options)
+        return
+
+    with open(path_dest, "wb+") as dest:
+        try:
+            decrypt_stream(path_src, dest, private_key, **options)
+        except BaseException:
+            dest.close()
+            os.remove(path_dest)
+            raise
+
+
+def decrypt_stream(
+    path_src: str,
+    dest,
+    private_key: tuple[int, ...],
+    workers=1,
+    buffer_size=None,
+    use_mmap=False,
+    offset=0,
+    length=None,
+):
+    """Decrypt a file, or a byte range of it, into a file-like object.
+
+    Ranges of uncompressed files are read directly. A compressed stream
+    has to be decompressed from its start, so a range of a compressed
+    file costs its offset plus its length.
+
+    Arguments:
+        path_src: The path to the encrypted source file.
+        dest: A file or file-like object (e.g. io.BytesIO) to write the
+            plaintext to.
+        private_key: The private key (d, n) or (d, n, p, q, dp, dq, qinv).
+        workers: The number of processes used to decrypt blocks.
+        buffer_size: The I/O buffer size for block files.
+        use_mmap: Whether to memory-map uncompressed block files.
+        offset: The plaintext offset to start decrypting at.
+        length: The number of bytes to decrypt, or None for all of them.
+
+    Raises:
+        ValueError: if the file is damaged or was compressed with an
+            algorithm that is not installed.
+    """
+    file_format, algorithm = file_info(path_src)
+    ranged = offset or length is not None
+
+    with open(path_src, "rb") as src:
+        if algorithm is None:
+            if file_format == "hybrid":
+                if ranged:
+                    hybrid.decrypt_range(
+                        src, dest, private_key, offset, length
+                    )
+                else:
+                    hybrid.decrypt_stream(src, dest, private_key)
+            elif ranged:
+                rsa.decrypt_range(
+                    src, dest, private_key, offset, length, buffer_size
+                )
+            else:
+                rsa.decrypt_stream(
+                    src, dest, private_key, workers, buffer_size, use_mmap
+                )
+            return
+
+        src.seek(len(MAGIC) + 1)
+        writer = _DecompressedWriter(
+            dest, ALGORITHMS[algorithm], offset, length
+        )
+        try:
+            if file_format == "hybrid":
+                hybrid.decrypt_stream(src, writer, private_key)
+            else:
+                rsa.decrypt_stream(
+                    src,
+                    writer,
+                    private_key,
+                    1 if ranged else workers,
+                    buffer_size,
+                )
+        except _Done:
+            return
+
+        if not writer.finished():
+            raise ValueError(f"{path_src} is truncated")
@@ -0,0 +1,431 @@
+"""This module implements hybrid (envelope) file encryption.
+
+A random session key is encrypted once with RSA and stored in the file
+header, while the file body is encrypted with ChaCha20-Poly1305 from the
+cryptography package. The body is split into chunks of CHUNK_SIZE bytes
+that are authenticated one by one, so a wrong key, a damaged or a
+truncated file is detected without reading the whole file first.
+
+File layout:
+    MAGIC (4 bytes) | cipher id (1 byte) | RSA block (n bytes) | body
+
+The body is a sequence of sealed chunks, each the ChaCha20-Poly1305
+encryption of CHUNK_SIZE plaintext bytes followed by its 16 bytes tag.
+The last chunk is shorter (possibly empty) and is marked final in the
+associated data, so dropping whole chunks from the end is detected too.
+
+Functions:
+    is_hybrid_file(path: str) -> bool:
+        Check whether a file was written by this module.
+    encrypt_file(path_src: str, path_dest: str, public_key: tuple[int,
+        int]):
+        Encrypt a file with a fresh session key wrapped by the public key.
+    encrypt_stream(src, dest, public_key: tuple[int, int]):
+        Encrypt everything read from src into dest, header included.
+    decrypt_file(path_src: str, path_dest: str, private_key: tuple[int,
+        ...]):
+        Decrypt a file written by encrypt_file.
+    decrypt_stream(src, dest, private_key: tuple[int, ...]):
+        Decrypt an encrypted file read from src into dest.
+    decrypt_range(src, dest, private_key: tuple[int, ...], offset: int,
+        length=None):
+        Decrypt a byte range of an encrypted file read from src into dest.
+    seal(data: bytes, key: bytes) -> bytes:
+        Encrypt and authenticate a message with a symmetric key.
+    unseal(blob: bytes, key: bytes) -> bytes:
+        Verify and decrypt a message produced by seal.
+"""
+
+import hashlib
+import hmac
+import os
+import sys
+import scrypt.rsa as rsa
+import scrypt.timing as timing
+import scrypt.utils as utils
+
+MAGIC = b"EDB\x02"
+
+CIPHER_CHACHA20 = 1
+CIPHER_CHACHA20_POLY1305 = 3
+
+KEY_SIZE = 32
+NONCE_SIZE = 16
+TAG_SIZE = 32
+AEAD_TAG_SIZE = 16
+CHUNK_SIZE = 1 << 20
+
+
+def _chacha20(key: bytes, nonce: bytes):
+    """Return a ChaCha20 transform function.
+
+    Arguments:
+        key: The symmetric key.
+        nonce: The nonce.
+
+    Returns:
+        A function mapping a chunk to its encrypted/decrypted form.
+    """
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms
+
+    cipher = Cipher(algorithms.ChaCha20(key, nonce), mode=None)
+    return cipher.encryptor().update
+
+
+def _aead(key: bytes):
+    """Return the ChaCha20-Poly1305 cipher of a session key.
+
+    Arguments:
+        key: The session key.
+    """
+    from cryptography.hazmat.primitives.ciphers.aead import (
+        ChaCha20Poly1305,
+    )
+
+    return ChaCha20Poly1305(key)
+
+
+def _chunk_nonce(nonce: bytes, index: int) -> bytes:
+    """Return the 12 bytes nonce of a chunk of the body.
+
+    Arguments:
+        nonce: The session nonce.
+        index: The index of the chunk.
+    """
+    return nonce[:4] + index.to_bytes(8, byteorder="little")
+
+
+def _chunk_ad(final: bool) -> bytes:
+    """Return the associated data of a chunk of the body.
+
+    Arguments:
+        final: Whether the chunk is the last one.
+    """
+    return MAGIC + bytes([CIPHER_CHACHA20_POLY1305, final])
+
+
+def _mac_key(key: bytes) -> bytes:
+    """Derive the authentication key used by seal/unseal.
+
+    Arguments:
+        key: The symmetric key.
+
+    Returns:
+        A key that is independent from the encryption key.
+    """
+    return hashlib.sha256(b"encdb-mac" + key).digest()
+
+
+def seal(data: bytes, key: bytes) -> bytes:
+    """Encrypt and authenticate a message with a symmetric key.
+
+    The message is handled in one piece, so it should be small.
+
+    Arguments:
+        data: The message to be sealed.
+        key: A KEY_SIZE bytes symmetric key.
+
+    Returns:
+        cipher id | nonce | ciphertext | HMAC-SHA256 tag.
+    """
+    nonce = os.urandom(NONCE_SIZE)
+    transform = _chacha20(key, nonce)
+
+    body = bytes([CIPHER_CHACHA20]) + nonce + transform(data)
+    tag = hmac.new(_mac_key(key), body, hashlib.sha256).digest()
+    return body + tag
+
+
+def unseal(blob: bytes, key: bytes) -> bytes:
+    """Verify and decrypt a message produced by seal.
+
+    Arguments:
+        blob: The sealed message.
+        key: The symmetric key it was sealed with.
+
+    Returns:
+        The original message.
+
+    Raises:
+        ValueError: if the message was sealed with another key
+            or has been tampered with.
+    """
+    body, tag = blob[:-TAG_SIZE], blob[-TAG_SIZE:]
+    expected = hmac.new(_mac_key(key), body, hashlib.sha256).digest()
+    if len(body) < 1 + NONCE_SIZE or not hmac.compare_digest(tag, expected):
+        raise ValueError("sealed data failed authentication")
+    if body[0] != CIPHER_CHACHA20:
+        raise ValueError(f"unknown cipher id {body[0]}")
+
+    nonce = body[1:1 + NONCE_SIZE]
+    transform = _chacha20(key, nonce)
+    return transform(body[1 + NONCE_SIZE:])
+
+
+def is_hybrid_file(path: str) -> bool:
+    """Check whether a file was written by this module.
+
+    Block RSA files have no header, so a match on the magic bytes is what
+    tells the two formats apart.
+
+    Arguments:
+        path: The path of the file to check.
+
+    Returns:
+        True if the file starts with the hybrid format header.
+    """
+    with open(path, "rb") as reader:
+        return reader.read(len(MAGIC)) == MAGIC
+
+
+def _check_key(public_key: tuple[int, int]):
+    """Check that a public key can wrap a session key.
+
+    Arguments:
+        public_key: The public key (e, n).
+
+    Raises:
+        ValueError: if the key is too short to wrap the session key.
+    """
+    n = public_key[1]
+    if utils.get_size_in_bytes(n) - 4 < KEY_SIZE + NONCE_SIZE:
+        raise ValueError("key is too short for hybrid encryption")
+
+
+def encrypt_file(path_src: str, path_dest: str, public_key: tuple[int, int]):
+    """Encrypt a file with a fresh session key wrapped by the public key.
+
+    Arguments:
+        path_src: The path to the source file to be encrypted.
+        path_dest: The path to save the encrypted file.
+        public_key: The public key (e, n) used to wrap the session key.
+
+    Raises:
+        ValueError: if the key is too short to wrap the session key.
+    """
+    _check_key(public_key)
+
+    with open(path_src, "rb") as src, open(path_dest, "wb+") as dest:
+        encrypt_stream(src, dest, public_key)
+
+
+def encrypt_stream(src, dest, public_key: tuple[int, int]):
+    """Encrypt everything read from src into dest, header included.
+
+    Arguments:
+        src: A file or file-like object to read the plaintext from; a
+            read returns fewer bytes than asked only at its end.
+        dest: A file or file-like object to write the encrypted file to.
+        public_key: The public key (e, n) used to wrap the session key.
+
+    Raises:
+        ValueError: if the key is too short to wrap the session key.
+    """
+    _check_key(public_key)
+
+    key = os.urandom(KEY_SIZE)
+    nonce = os.urandom(NONCE_SIZE)
+    aead = _aead(key)
+
+    dest.write(MAGIC)
+    dest.write(bytes([CIPHER_CHACHA20_POLY1305]))
+    dest.write(rsa.encrypt(key + nonce, public_key))
+
+    index = 0
+    while True:
+        with timing.phase("io.read"):
+            chunk = src.read(CHUNK_SIZE)
+        final = len(chunk) < CHUNK_SIZE
+
+        with timing.phase("crypto"):
+            sealed = aead.encrypt(
+                _chunk_nonce(nonce, index), chunk, _chunk_ad(final)
+            )
+        with timing.phase("io.write"):
+            dest.write(sealed)
+        timing.count("bytes_in", len(chunk))
+        timing.count("bytes_out", len(sealed))
+
+        if final:
+            return
+        index += 1
+
+
+def _read_header(src, private_key: tuple[int, ...]):
+    """Read the header of a hybrid file and unwrap its session key.
+
+    Arguments:
+        src: The encrypted file, positioned at the start of the header.
+        private_key: The private key used to unwrap the session key.
+
+    Returns:
+        A tuple (key, nonce). src is left at the start of the body.
+
+    Raises:
+        ValueError: if the file is not in the hybrid format.
+    """
+    n = private_key[1]
+
+    if src.read(len(MAGIC)) != MAGIC:
+        raise ValueError(f"{src.name} is not a hybrid encrypted file")
+
+    cipher_id = src.read(1)[0]
+    if cipher_id != CIPHER_CHACHA20_POLY1305:
+        raise ValueError(f"unknown cipher id {cipher_id}")
+
+    wrapped = src.read(utils.get_size_in_bytes(n))
+    session = rsa.decrypt(wrapped, private_key)
+    key = session[:KEY_SIZE]
+    nonce = session[KEY_SIZE:KEY_SIZE + NONCE_SIZE]
+
+    return key, nonce
+
+
+def _chunks(src, key: bytes, nonce: bytes, first: int = 0):
+    """Decrypt the chunks of a body, checking every one of them.
+
+    Arguments:
+        src: The encrypted file, positioned at the chunk first.
+        key: The session key.
+        nonce: The session nonce.
+        first: The index of the first chunk to decrypt.
+
+    Yields:
+        The plaintext of the chunks, in order.
+
+    Raises:
+        ValueError: if a chunk fails authentication (a wrong key or a
+            damaged file) or the file is truncated.
+    """
+    from cryptography.exceptions import InvalidTag
+
+    aead = _aead(key)
+    size = CHUNK_SIZE + AEAD_TAG_SIZE
+    index = first
+    while True:
+        with timing.phase("io.read"):
+            data = src.read(size)
+        if not data:
+            raise ValueError(f"{src.name} is truncated")
+
+        final = len(data) < size
+        try:
+            with timing.phase("crypto"):
+                chunk = aead.decrypt(
+                    _chunk_nonce(nonce, index), data, _chunk_ad(final)
+                )
+        except InvalidTag:
+            raise ValueError(
+                f"{src.name} failed authentication "
+                "(wrong key or damaged file)"
+            ) from None
+        timing.count("bytes_in", len(data))
+        timing.count("bytes_out", len(chunk))
+        yield chunk
+
+        if final:
+            return
+        index += 1
+
+
+def decrypt_file(
+    path_src: str, path_dest: str, private_key: tuple[int, ...]
+):
+    """Decrypt a file written by encrypt_file.
+
+    The output is removed if the file fails authentication.
+
+    Arguments:
+        path_src: The path to the encrypted source file.
+        path_dest: The path to save the decrypted file, or None for stdout.
+        private_key: The private key (d, n) or (d, n, p, q, dp, dq, qinv)
+            used to unwrap the session key.
+
+    Raises:
+        ValueError: if the file is not in the hybrid format, is damaged
+            or was encrypted with another key.
+    """
+    with open(path_src, "rb") as src:
+        if path_dest is None:
+            decrypt_stream(src, sys.stdout.buffer, private_key)
+            return
+
+        with open(path_dest, "wb+") as dest:
+            try:
+                decrypt_stream(src, dest, private_key)
+            except BaseException:
+                dest.close()
+                os.remove(path_dest)
+                raise
+
+
+def decrypt_stream(src, dest, private_key: tuple[int, ...]):
+    """Decrypt an encrypted file read from src into dest.
+
+    Arguments:
+        src: The encrypted file, positioned at the start of the header.
+        dest: A file or file-like object to write the plaintext to.
+        private_key: The private key (d, n) or (d, n, p, q, dp, dq, qinv)
+            used to unwrap the session key.
+
+    Raises:
+        ValueError: if the file is not in the hybrid format, is damaged
+            or was encrypted with another key.
+    """
+    key, nonce = _read_header(src, private_key)
+    for chunk in _chunks(src, key, nonce):
+        with timing.phase("io.write"):
+            dest.write(chunk)
+
+
+def decrypt_range(
+    src,
+    dest,
+    private_key: tuple[int, ...],
+    offset: int,
+    length=None,
+):
+    """Decrypt a byte range of an encrypted file read from src into dest.
+
+    Decryption starts at the chunk that holds offset, so only the chunks
+    that cover the range are read, checked and decrypted. A range that
+    runs past the end of the file is cut short.
+
+    Arguments:
+        src: The encrypted file, positioned at the start of the header;
+            it must be seekable.
+        dest: A file or file-like object to write the plaintext to.
+        private_key: The private key (d, n) or (d, n, p, q, dp, dq, qinv)
+            used to unwrap the session key.
+        offset: The plaintext offset of the first byte to decrypt.
+        length: The number of bytes to decrypt, or None to decrypt to the
+            end of the file.
+
+    Raises:
+        ValueError: if the file is not in the hybrid format, is damaged
+            or was encrypted with another key.
+    """
+    key, nonce = _read_header(src, private_key)
+
+    # start at the last chunk at most, so a range past the end still
+    # checks the final chunk
+    body_start = src.tell()
+    body = src.seek(0, os.SEEK_END) - body_start
+    size = CHUNK_SIZE + AEAD_TAG_SIZE
+    chunk = min(offset // CHUNK_SIZE, max(0, (body - 1) // size))
+    skip = offset - chunk * CHUNK_SIZE
+    remaining = length
+    src.seek(body_start + chunk * size)
+
+    for plaintext in _chunks(src, key, nonce, chunk):
+        if remaining is not None and remaining <= 0:
+            break
+
+        plaintext = plaintext[skip:]
+        skip = max(0, skip - CHUNK_SIZE)
+        if remaining is not None:
+            plaintext = plaintext[:remaining]
+            remaining -= len(plaintext)
+
+        with timing.phase("io.write"):
+            dest.write(plaintext)
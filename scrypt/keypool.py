@@ -0,0 +1,103 @@
+"""This module prepares RSA key pairs ahead of time for a key pool.
+
+Key pairs are generated on several processes and sealed with a key
+derived from a pool secret, so they can be stored at rest and handed
+out instantly by the generate subcommand.
+
+Functions:
+    derive_pool_key(secret: str) -> bytes:
+        Derive the symmetric key that protects the pooled key pairs.
+    generate_key_pairs(count: int, key_len: int, workers: int)
+        -> list[tuple[tuple[int, int], tuple[int, ...]]]:
+        Generate several key pairs in parallel.
+    seal_key_pair(key_pair, pool_key: bytes) -> bytes:
+        Serialize and seal a key pair.
+    unseal_key_pair(blob: bytes, pool_key: bytes)
+        -> tuple[tuple[int, int], tuple[int, ...]]:
+        Unseal and deserialize a key pair.
+"""
+
+import base64
+import hashlib
+import sys
+import scrypt.hybrid as hybrid
+import scrypt.rsa as rsa
+import scrypt.utils as utils
+
+POOL_SALT = b"encdb-key-pool"
+
+
+def derive_pool_key(secret: str) -> bytes:
+    """Derive the symmetric key that protects the pooled key pairs.
+
+    Arguments:
+        secret: The pool secret from config.json.
+
+    Returns:
+        A hybrid.KEY_SIZE bytes key.
+    """
+    return hashlib.scrypt(
+        secret.encode("utf-8"),
+        salt=POOL_SALT,
+        n=1 << 14,
+        r=8,
+        p=1,
+        dklen=hybrid.KEY_SIZE,
+    )
+
+
+def generate_key_pairs(
+    count: int, key_len: int, workers: int
+) -> list[tuple[tuple[int, int], tuple[int, ...]]]:
+    """Generate several key pairs in parallel.
+
+    Arguments:
+        count: The number of key pairs.
+        key_len: The length of each key in bits.
+        workers: The number of worker processes.
+
+    Returns:
+        A list of (public_key, private_key) tuples.
+    """
+    if workers <= 1:
+        return [rsa.key_gen(key_len) for _ in range(count)]
+
+    with utils.worker_pool(workers) as executor:
+        return list(executor.map(rsa.key_gen, [key_len] * count))
+
+
+def seal_key_pair(key_pair, pool_key: bytes) -> bytes:
+    """Serialize and seal a key pair.
+
+    Arguments:
+        key_pair: A (public_key, private_key) tuple.
+        pool_key: The key returned by derive_pool_key.
+
+    Returns:
+        The sealed key pair.
+    """
+    public_key, private_key = key_pair
+    fields = utils.base64_tuple(public_key + private_key)
+    return hybrid.seal(b",".join(fields), pool_key)
+
+
+def unseal_key_pair(
+    blob: bytes, pool_key: bytes
+) -> tuple[tuple[int, int], tuple[int, ...]]:
+    """Unseal and deserialize a key pair.
+
+    Arguments:
+        blob: A key pair sealed by seal_key_pair.
+        pool_key: The key returned by derive_pool_key.
+
+    Returns:
+        A (public_key, private_key) tuple.
+
+    Raises:
+        ValueError: if the blob was sealed with another secret.
+    """
+    fields = tuple(
+        int.from_bytes(base64.b64decode(x), byteorder=sys.byteorder)
+        for x in hybrid.unseal(blob, pool_key).split(b",")
+    )
+    return fields[:2], fields[2:]
@@ -1,25 +1,154 @@
 """This module provides number theory functions.
 
 Functions:
+    is_probable_prime(n: int, rounds: int | None = None) -> bool:
+        Test whether a number is prime with the Miller-Rabin test.
     prime_gen(size: int) -> int: Generate a random prime number.
 """
 
 import random
-import sympy
+from functools import cache
+
+SIEVE_LIMIT = 1 << 14
+SIEVE_WINDOW = 4096
+
+_rng = random.SystemRandom()
+
+
+@cache
+def _small_primes(limit: int) -> list[int]:
+    """Return all the primes below limit (sieve of Eratosthenes).
+
+    The result is cached, so the sieve only runs the first time primes
+    are needed rather than when the module is imported.
+
+    Arguments:
+        limit: the exclusive upper bound.
+
+    Returns:
+        The list of primes below limit, in increasing order.
+    """
+    sieve = bytearray([1]) * limit
+    sieve[0:2] = b"\x00\x00"
+    for i in range(2, int(limit**0.5) + 1):
+        if sieve[i]:
+            sieve[i * i::i] = bytes(len(range(i * i, limit, i)))
+
+    return [i for i in range(limit) if sieve[i]]
+
+
+def _mr_rounds(bits: int) -> int:
+    """Return the Miller-Rabin rounds needed for a random candidate.
+
+    The counts keep the error probability for random odd candidates below
+    2^-80 (Handbook of Applied Cryptography, table 4.4).
+
+    Arguments:
+        bits: the size of the candidate in bits.
+
+    Returns:
+        The number of rounds.
+    """
+    table = (
+        (1300, 2),
+        (850, 3),
+        (650, 4),
+        (550, 5),
+        (450, 6),
+        (400, 7),
+        (350, 8),
+        (300, 9),
+        (250, 12),
+        (200, 15),
+        (150, 18),
+    )
+    for size, rounds in table:
+        if bits >= size:
+            return rounds
+
+    return 27
+
+
+def is_probable_prime(n: int, rounds: int | None = None) -> bool:
+    """Test whether a number is prime with the Miller-Rabin test.
+
+    Arguments:
+        n: the number to be tested.
+        rounds: the number of random bases, or None to pick it from the
+            size of n.
+
+    Returns:
+        False if n is composite, True if n is prime with overwhelming
+        probability.
+    """
+    if n < 2:
+        return False
+    for p in _small_primes(SIEVE_LIMIT)[:64]:
+        if n % p == 0:
+            return n == p
+
+    if rounds is None:
+        rounds = _mr_rounds(n.bit_length())
+
+    d = n - 1
+    s = 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+
+    for _ in range(rounds):
+        a = _rng.randrange(2, n - 1)
+        x = pow(a, d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for _ in range(s - 1):
+            x = pow(x, 2, n)
+            if x == n - 1:
+                break
+        else:
+            return False
+
+    return True
 
 
 def prime_gen(size: int) -> int:
     """Generate a random prime number.
 
+    The two most significant bits are set, so the product of two primes
+    of the same size is exactly twice as long. Candidates are taken from
+    a window of odd numbers that is sieved with the small primes before
+    the Miller-Rabin test.
+
     Arguments:
         size: size of the number to be generated (in bits).
 
     Returns:
-        A prime number that needs <=size bits to be written.
+        A prime number that needs exactly size bits to be written.
+
+    Raises:
+        ValueError: if size is smaller than 2.
     """
+    if size < 2:
+        raise ValueError("a prime needs at least 2 bits")
+
+    small_primes = _small_primes(SIEVE_LIMIT)
+    if (1 << size) <= SIEVE_LIMIT:
+        return _rng.choice(
+            [p for p in small_primes if p.bit_length() == size]
+        )
+
     while True:
-        p = random.randint(0, (1 << size) - 1)
-        if sympy.isprime(p):
-            break
+        start = _rng.getrandbits(size) | (3 << (size - 2)) | 1
+
+        # sieve[i] is 0 when start + 2 * i has a small prime factor
+        sieve = bytearray([1]) * SIEVE_WINDOW
+        for p in small_primes[1:]:
+            first = (-(start % p) * ((p + 1) // 2)) % p
+            sieve[first::p] = bytes(len(range(first, SIEVE_WINDOW, p)))
 
-    return p
+        for i in range(SIEVE_WINDOW):
+            candidate = start + 2 * i
+            if candidate >> size:
+                break
+            if sieve[i] and is_probable_prime(candidate):
+                return candidate
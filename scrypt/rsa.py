@@ -1,43 +1,89 @@
 """This module provides an implementation of RSA.
 
+Private keys come in two forms: the plain (d, n) pair and the extended
+(d, n, p, q, dp, dq, qinv) tuple, which lets decryption use the Chinese
+Remainder Theorem instead of a full-width exponentiation.
+
+Classes:
+    RSAKeyContext: Per-key constants for encrypting or decrypting
+        many blocks.
+
 Functions:
-    key_gen(key_len: int) -> tuple[tuple[int, int], tuple[int, int]]:
+    key_gen(key_len: int) -> tuple[tuple[int, int], tuple[int, ...]]:
         Generate a public and a private key for RSA encryption/decryption.
     encrypt(plaintext: bytes, public_key: tuple[int, int]) -> bytes:
         Encrypt a plaintext message using the public RSA key.
-    decrypt(ciphertext: bytes, private_key: tuple[int, int]) -> bytes:
+    private_pow(c: int, private_key: tuple[int, ...]) -> int:
+        Raise c to the private exponent modulo n.
+    decrypt(ciphertext: bytes, private_key: tuple[int, ...]) -> bytes:
         Decrypt a ciphertext message using the private RSA key.
     encrypt_file(path_src: str, path_dest: str, public_key: tuple[int,
-        int]):
+        int], workers=1, buffer_size=None, use_mmap=False):
         Encrypt a file using the public RSA key.
     decrypt_file(path_src: str, path_dest: str, private_key: tuple[int,
-        int]):
+        ...], workers=1, buffer_size=None, use_mmap=False):
         Decrypt a file using the private RSA key.
+    encrypt_stream(src, dest, public_key: tuple[int, int], workers=1,
+        buffer_size=None):
+        Encrypt everything read from src into dest.
+    decrypt_stream(src, dest, private_key: tuple[int, ...], workers=1,
+        buffer_size=None, use_mmap=False):
+        Decrypt everything read from src into dest.
+    decrypt_range(src, dest, private_key: tuple[int, ...], offset: int,
+        length=None, buffer_size=None):
+        Decrypt a byte range of an encrypted file read from src into dest.
+    chunk_size(key: tuple[int, ...]) -> int:
+        Return the plaintext size of the chunks of update_file.
+    update_file(path_src: str, path_dest: str, public_key: tuple[int,
+        int], chunks):
+        Re-encrypt some chunks of a file in place.
 """
 
+import os
 import random
 import sys
+import scrypt.timing as timing
 import scrypt.utils as utils
+from functools import cache
 from math import gcd
 from scrypt.nt import prime_gen
 
+CHUNK_BLOCKS = 256
+
 
-def key_gen(key_len: int) -> tuple[tuple[int, int], tuple[int, int]]:
+@cache
+def _gmpy2():
+    """Import gmpy2 on first use.
+
+    Returns:
+        The gmpy2 module, or None if it is not installed.
+    """
+    try:
+        import gmpy2
+    except ImportError:
+        return None
+
+    return gmpy2
+
+
+def key_gen(key_len: int) -> tuple[tuple[int, int], tuple[int, ...]]:
     """Generate a public and a private key for RSA encryption/decryption.
 
     Arguments:
         key_len: length of the key in bits.
 
     Returns:
-        A tuple (public_key, private_key) containing RSA keys.
+        A tuple (public_key, private_key) containing RSA keys. The private
+        key is in the extended (d, n, p, q, dp, dq, qinv) form.
     """
-    p = prime_gen(key_len // 2)
-    q = prime_gen(key_len // 2)
-
-    while p == q:
+    with timing.phase("primes"):
         p = prime_gen(key_len // 2)
         q = prime_gen(key_len // 2)
 
+        while p == q:
+            p = prime_gen(key_len // 2)
+            q = prime_gen(key_len // 2)
+
     n = p * q
     phi = (p - 1) * (q - 1)
     if phi > 65537:
@@ -52,9 +98,12 @@ def key_gen(key_len: int) -> tuple[tuple[int, int], tuple[int, int]]:
             e = random.randint(2, phi - 1)
 
     d = pow(e, -1, phi)
+    dp = d % (p - 1)
+    dq = d % (q - 1)
+    qinv = pow(q, -1, p)
 
     public_key = (e, n)
-    private_key = (d, n)
+    private_key = (d, n, p, q, dp, dq, qinv)
 
     return public_key, private_key
 
@@ -63,7 +112,7 @@ def encrypt(plaintext: bytes, public_key: tuple[int, int]) -> bytes:
     """Encrypt a plaintext message using the public RSA key.
 
     Arguments:
-        plaintext: The message to be encrypted.
+        plaintext: The message to be encrypted (any bytes-like object).
         public_key: The public key (e, n) for RSA encryption.
 
     Returns:
@@ -71,35 +120,70 @@ def encrypt(plaintext: bytes, public_key: tuple[int, int]) -> bytes:
     """
     e = public_key[0]
     n = public_key[1]
+    key_len = utils.get_size_in_bytes(n)
 
-    m = int.from_bytes(
-        utils.pad(plaintext, utils.get_size_in_bytes(n)),
-        byteorder=sys.byteorder,
-    )
+    padded = utils.pad(plaintext, key_len)
+    m = int.from_bytes(padded, byteorder=sys.byteorder)
     c = pow(m, e, n)
 
-    ciphertext = c.to_bytes(
-        utils.get_size_in_bytes(n), byteorder=sys.byteorder
-    )
+    ciphertext = c.to_bytes(key_len, byteorder=sys.byteorder)
 
     return ciphertext
 
 
-def decrypt(ciphertext: bytes, private_key: tuple[int, int]) -> bytes:
+def _crt_pow(c, p, q, dp, dq, qinv, modpow=pow) -> int:
+    """Raise c to the private exponent with the Chinese Remainder Theorem.
+
+    Arguments:
+        c: The integer to be exponentiated.
+        p, q, dp, dq, qinv: The CRT parameters of an extended private key.
+        modpow: The modular exponentiation function (pow or
+            gmpy2.powmod).
+
+    Returns:
+        c^d mod n.
+    """
+    m1 = modpow(c, dp, p)
+    m2 = modpow(c, dq, q)
+
+    return int(m2 + (qinv * (m1 - m2)) % p * q)
+
+
+def private_pow(c: int, private_key: tuple[int, ...]) -> int:
+    """Raise c to the private exponent modulo n.
+
+    Extended private keys are evaluated with the Chinese Remainder Theorem,
+    which works on half-width numbers and is several times faster.
+
+    Arguments:
+        c: The integer to be exponentiated.
+        private_key: The private key, either (d, n) or
+            (d, n, p, q, dp, dq, qinv).
+
+    Returns:
+        c^d mod n.
+    """
+    if len(private_key) == 2:
+        return pow(c, private_key[0], private_key[1])
+
+    return _crt_pow(c, *private_key[2:7])
+
+
+def decrypt(ciphertext: bytes, private_key: tuple[int, ...]) -> bytes:
     """Decrypt a ciphertext message using the private RSA key.
 
     Arguments:
-        ciphertext: The encrypted message.
-        private_key: The private key (d, n) for RSA decryption.
+        ciphertext: The encrypted message (any bytes-like object).
+        private_key: The private key (d, n) or (d, n, p, q, dp, dq, qinv)
+            for RSA decryption.
 
     Returns:
         The decrypted plaintext.
     """
-    d = private_key[0]
     n = private_key[1]
 
     c = int.from_bytes(ciphertext, byteorder=sys.byteorder)
-    m = pow(c, d, n)
+    m = private_pow(c, private_key)
 
     plaintext = m.to_bytes(utils.get_size_in_bytes(m), byteorder=sys.byteorder)
     plaintext, plaintext_len = utils.unpad(
@@ -110,40 +194,391 @@ def decrypt(ciphertext: bytes, private_key: tuple[int, int]) -> bytes:
     return plaintext
 
 
-def encrypt_file(path_src: str, path_dest: str, public_key: tuple[int, int]):
+class RSAKeyContext:
+    """Per-key constants for encrypting or decrypting many blocks.
+
+    The byte length of n, the CRT parameters of extended private keys and
+    the padding buffer are set up once instead of once per block. When
+    gmpy2 is installed, the numbers are kept as gmpy2.mpz and the
+    exponentiations run on GMP.
+
+    Attributes:
+        key: The key the context was built from.
+        key_len: The size of n in bytes.
+        block_size: The number of plaintext bytes in one block.
+    """
+
+    def __init__(self, key: tuple[int, ...]):
+        """Precompute the constants of a key.
+
+        Arguments:
+            key: A public key (e, n) to encrypt with, or a private key
+                (d, n) or (d, n, p, q, dp, dq, qinv) to decrypt with.
+        """
+        gmpy2 = _gmpy2()
+        number = gmpy2.mpz if gmpy2 is not None else int
+
+        self.key = key
+        self.key_len = utils.get_size_in_bytes(key[1])
+        self.block_size = self.key_len - 1 - 3
+        self.exponent = number(key[0])
+        self.n = number(key[1])
+        self.crt = tuple(number(x) for x in key[2:7]) or None
+        self.buffer = bytearray(self.key_len - 1)
+        self.pow = gmpy2.powmod if gmpy2 is not None else pow
+
+    def decrypt_block(self, ciphertext) -> bytes:
+        """Decrypt one key_len bytes block.
+
+        Arguments:
+            ciphertext: The block to be decrypted (any bytes-like object).
+
+        Returns:
+            The plaintext.
+        """
+        c = int.from_bytes(ciphertext, byteorder=sys.byteorder)
+        if self.crt is None:
+            m = int(self.pow(c, self.exponent, self.n))
+        else:
+            m = _crt_pow(c, *self.crt, self.pow)
+
+        plaintext = m.to_bytes(utils.get_size_in_bytes(m), sys.byteorder)
+        plaintext, plaintext_len = utils.unpad(plaintext, self.key_len)
+
+        return plaintext + b"\x00" * (plaintext_len - len(plaintext))
+
+    def encrypt_blocks(self, blocks) -> list[bytes]:
+        """Encrypt a list of blocks.
+
+        The blocks are padded one after the other in the buffer of the
+        context, from one random_padding draw for the whole list.
+
+        Arguments:
+            blocks: Blocks of at most block_size bytes.
+
+        Returns:
+            The ciphertexts, in order.
+        """
+        key_len = self.key_len
+        exponent = self.exponent
+        n = self.n
+        modpow = self.pow
+        buffer = self.buffer
+
+        sizes = [key_len - 1 - len(block) - 3 for block in blocks]
+        padding = memoryview(utils.random_padding(sum(sizes)))
+
+        ciphertexts = []
+        pos = 0
+        for block, size in zip(blocks, sizes):
+            utils.pad_into(buffer, block, key_len, padding[pos:pos + size])
+            pos += size
+            m = int.from_bytes(buffer, byteorder=sys.byteorder)
+            c = int(modpow(m, exponent, n))
+            ciphertexts.append(c.to_bytes(key_len, byteorder=sys.byteorder))
+
+        return ciphertexts
+
+    def decrypt_blocks(self, blocks) -> list[bytes]:
+        """Decrypt a list of blocks.
+
+        Arguments:
+            blocks: Blocks of key_len bytes.
+
+        Returns:
+            The plaintexts, in order.
+        """
+        decrypt_block = self.decrypt_block
+        return [decrypt_block(block) for block in blocks]
+
+
+def _walk(
+    src, dest, block_size: int, func, workers: int, buffer_size, use_mmap
+):
+    """Run func over the blocks of src, in parallel if workers > 1.
+
+    Arguments:
+        src: The source file to read blocks from.
+        dest: The destination file to write the results to.
+        block_size: The size of each block.
+        func: A picklable function mapping a list of blocks to the list
+            of their results (e.g. RSAKeyContext.encrypt_blocks).
+        workers: The number of worker processes.
+        buffer_size: The I/O buffer size in bytes, or None to read and
+            write one block at a time.
+        use_mmap: Whether to memory-map src when running in one process.
+    """
+    if workers > 1:
+        utils.parallel_block_walk(src, dest, block_size, func, workers)
+    elif use_mmap:
+        utils.mmap_block_walk(
+            src,
+            dest,
+            block_size,
+            func,
+            buffer_size or utils.DEFAULT_BUFFER_SIZE,
+        )
+    elif buffer_size:
+        utils.buffered_block_walk(src, dest, block_size, func, buffer_size)
+    else:
+        utils.block_walk(src, dest, block_size, func)
+
+
+def encrypt_file(
+    path_src: str,
+    path_dest: str,
+    public_key: tuple[int, int],
+    workers=1,
+    buffer_size=None,
+    use_mmap=False,
+):
     """Encrypt a file using the public RSA key.
 
     Arguments:
         path_src: The path to the source file to be encrypted.
         path_dest: The path to save the encrypted file.
         public_key: The public key (e, n) for RSA encryption.
+        workers: The number of processes used to encrypt blocks.
+        buffer_size: The I/O buffer size in bytes, or None to read and
+            write one block at a time.
+        use_mmap: Whether to memory-map the source file.
     """
-    n = public_key[1]
-    block_size = utils.get_size_in_bytes(n) - 1 - 3
+    context = RSAKeyContext(public_key)
+    block_size = context.block_size
+    encrypt_func = context.encrypt_blocks
 
     with open(path_src, "rb") as src, open(path_dest, "wb+") as dest:
-        utils.block_walk(
-            src, dest, block_size, lambda x: encrypt(x, public_key)
+        _walk(
+            src, dest, block_size, encrypt_func, workers, buffer_size, use_mmap
         )
 
 
-def decrypt_file(path_src: str, path_dest: str, private_key: tuple[int, int]):
+def decrypt_file(
+    path_src: str,
+    path_dest: str,
+    private_key: tuple[int, ...],
+    workers=1,
+    buffer_size=None,
+    use_mmap=False,
+):
     """Decrypt a file using the private RSA key.
 
     Arguments:
         path_src: The path to the encrypted source file.
         path_dest: The path to save the decrypted file, or None for stdout.
-        private_key: The private key (d, n) for RSA decryption.
+        private_key: The private key (d, n) or (d, n, p, q, dp, dq, qinv)
+            for RSA decryption.
+        workers: The number of processes used to decrypt blocks.
+        buffer_size: The I/O buffer size in bytes, or None to read and
+            write one block at a time.
+        use_mmap: Whether to memory-map the source file.
     """
-    n = private_key[1]
-    block_size = utils.get_size_in_bytes(n)
-
-    def decrypt_func(x):
-        return decrypt(x, private_key)
+    context = RSAKeyContext(private_key)
+    block_size = context.key_len
+    decrypt_func = context.decrypt_blocks
 
     with open(path_src, "rb") as src:
         if path_dest is not None:
             with open(path_dest, "wb+") as dest:
-                utils.block_walk(src, dest, block_size, decrypt_func)
+                _walk(
+                    src,
+                    dest,
+                    block_size,
+                    decrypt_func,
+                    workers,
+                    buffer_size,
+                    use_mmap,
+                )
         else:
-            utils.block_walk(src, sys.stdout.buffer, block_size, decrypt_func)
+            _walk(
+                src,
+                sys.stdout.buffer,
+                block_size,
+                decrypt_func,
+                workers,
+                buffer_size,
+                use_mmap,
+            )
+
+
+def encrypt_stream(
+    src, dest, public_key: tuple[int, int], workers=1, buffer_size=None
+):
+    """Encrypt everything read from src into dest.
+
+    Arguments:
+        src: A file or file-like object to read the plaintext from.
+        dest: A file or file-like object to write the ciphertext to.
+        public_key: The public key (e, n) for RSA encryption.
+        workers: The number of processes used to encrypt blocks.
+        buffer_size: The I/O buffer size in bytes, or None to read and
+            write one block at a time.
+    """
+    context = RSAKeyContext(public_key)
+    _walk(
+        src,
+        dest,
+        context.block_size,
+        context.encrypt_blocks,
+        workers,
+        buffer_size,
+        False,
+    )
+
+
+def decrypt_stream(
+    src,
+    dest,
+    private_key: tuple[int, ...],
+    workers=1,
+    buffer_size=None,
+    use_mmap=False,
+):
+    """Decrypt everything read from src into dest.
+
+    Arguments:
+        src: A file or file-like object to read the ciphertext from.
+        dest: A file or file-like object to write the plaintext to.
+        private_key: The private key (d, n) or (d, n, p, q, dp, dq, qinv)
+            for RSA decryption.
+        workers: The number of processes used to decrypt blocks.
+        buffer_size: The I/O buffer size in bytes, or None to read and
+            write one block at a time.
+        use_mmap: Whether to memory-map src, which must then be a file
+            with a fileno.
+    """
+    context = RSAKeyContext(private_key)
+    _walk(
+        src,
+        dest,
+        context.key_len,
+        context.decrypt_blocks,
+        workers,
+        buffer_size,
+        use_mmap,
+    )
+
+
+def decrypt_range(
+    src,
+    dest,
+    private_key: tuple[int, ...],
+    offset: int,
+    length=None,
+    buffer_size=None,
+):
+    """Decrypt a byte range of an encrypted file read from src into dest.
+
+    Every block but the last holds exactly key_len - 4 plaintext bytes,
+    so only the ciphertext blocks that cover the range are read and
+    decrypted. A range that runs past the end of the file is cut short.
+
+    Arguments:
+        src: The encrypted file; it must be seekable.
+        dest: A file or file-like object to write the plaintext to.
+        private_key: The private key (d, n) or (d, n, p, q, dp, dq, qinv)
+            for RSA decryption.
+        offset: The plaintext offset of the first byte to decrypt.
+        length: The number of bytes to decrypt, or None to decrypt to the
+            end of the file.
+        buffer_size: The approximate number of bytes read per call, or
+            None to read one block at a time.
+    """
+    context = RSAKeyContext(private_key)
+    key_len = context.key_len
+    block_size = context.block_size
+    batch = max(1, (buffer_size or key_len) // key_len)
+
+    first = offset // block_size
+    skip = offset - first * block_size
+    remaining = length
+
+    src.seek(first * key_len)
+    while remaining is None or remaining > 0:
+        count = batch
+        if remaining is not None:
+            count = min(count, -(-(skip + remaining) // block_size))
+
+        with timing.phase("io.read"):
+            data = src.read(count * key_len)
+        if not data:
+            break
+
+        with timing.phase("crypto"):
+            plaintext = b"".join(
+                context.decrypt_blocks(
+                    [
+                        data[i:i + key_len]
+                        for i in range(0, len(data), key_len)
+                    ]
+                )
+            )
+        timing.count("blocks", -(-len(data) // key_len))
+
+        plaintext = plaintext[skip:]
+        skip = 0
+        if remaining is not None:
+            plaintext = plaintext[:remaining]
+            remaining -= len(plaintext)
+
+        with timing.phase("io.write"):
+            dest.write(plaintext)
+
+
+def chunk_size(key: tuple[int, ...]) -> int:
+    """Return the plaintext size of the chunks of update_file.
+
+    A chunk is CHUNK_BLOCKS blocks, so it is encrypted to a fixed size
+    range of the encrypted file.
+
+    Arguments:
+        key: A public or private key.
+
+    Returns:
+        The chunk size in bytes.
+    """
+    return CHUNK_BLOCKS * (utils.get_size_in_bytes(key[1]) - 4)
+
+
+def update_file(
+    path_src: str, path_dest: str, public_key: tuple[int, int], chunks
+):
+    """Re-encrypt some chunks of a file in place.
+
+    The other chunks of path_dest must already hold the encryption of
+    the same chunks of path_src; the file is truncated to the size of
+    path_src.
+
+    Arguments:
+        path_src: The path to the new version of the source file.
+        path_dest: The path to the file encrypted by encrypt_file.
+        public_key: The public key (e, n) the file is encrypted with.
+        chunks: The indices of the chunks (of chunk_size bytes) that
+            changed.
+    """
+    context = RSAKeyContext(public_key)
+    block_size = context.block_size
+    size = chunk_size(public_key)
+    encrypted_size = CHUNK_BLOCKS * context.key_len
+
+    with open(path_src, "rb") as src, open(path_dest, "r+b") as dest:
+        for index in chunks:
+            with timing.phase("io.read"):
+                src.seek(index * size)
+                chunk = src.read(size)
+            with timing.phase("crypto"):
+                result = b"".join(
+                    context.encrypt_blocks(
+                        [
+                            chunk[i:i + block_size]
+                            for i in range(0, len(chunk), block_size)
+                        ]
+                    )
+                )
+            with timing.phase("io.write"):
+                dest.seek(index * encrypted_size)
+                dest.write(result)
+            timing.count("chunks")
+
+        blocks = -(-os.fstat(src.fileno()).st_size // block_size)
+        dest.truncate(blocks * context.key_len)
@@ -0,0 +1,126 @@
+"""This module collects per-phase timings and counters.
+
+Collection is off until enable() is called; while it is off, phase()
+and count() do nothing, so the hooks can stay in the hot paths. Only
+the calling process is measured: with worker processes, the time spent
+waiting for them is reported under the phase that waits. Phases may
+nest (e.g. "sqlite" inside "db.connect"); each reports its own wall time.
+
+Classes:
+    Timings: Accumulated durations and counters.
+
+Functions:
+    enable() -> Timings: Start collecting timings.
+    disable(): Stop collecting timings.
+    phase(name: str): Time the enclosed block under a phase name.
+    count(name: str, amount: int = 1): Add to a counter.
+    report() -> dict | None: Return the collected timings.
+"""
+
+import time
+from contextlib import contextmanager, nullcontext
+
+
+class Timings:
+    """Accumulated durations and counters.
+
+    Attributes:
+        phases: phase name -> [seconds, calls].
+        counters: counter name -> value.
+        start: the perf_counter value when collection started.
+    """
+
+    def __init__(self):
+        """Create empty timings."""
+        self.phases = {}
+        self.counters = {}
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name: str):
+        """Time the enclosed block under a phase name.
+
+        Arguments:
+            name: the phase name, e.g. "crypto" or "sqlite".
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            entry = self.phases.setdefault(name, [0.0, 0])
+            entry[0] += time.perf_counter() - start
+            entry[1] += 1
+
+    def count(self, name: str, amount: int = 1):
+        """Add to a counter.
+
+        Arguments:
+            name: the counter name, e.g. "blocks".
+            amount: the value to add.
+        """
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def report(self) -> dict:
+        """Return the timings as a JSON serializable dict."""
+        return {
+            "total_seconds": time.perf_counter() - self.start,
+            "phases": {
+                name: {"seconds": seconds, "calls": calls}
+                for name, (seconds, calls) in self.phases.items()
+            },
+            "counters": dict(self.counters),
+        }
+
+
+_current = None
+
+
+def enable() -> Timings:
+    """Start collecting timings.
+
+    Returns:
+        the Timings that collects them.
+    """
+    global _current
+    _current = Timings()
+    return _current
+
+
+def disable():
+    """Stop collecting timings."""
+    global _current
+    _current = None
+
+
+def phase(name: str):
+    """Time the enclosed block under a phase name.
+
+    Arguments:
+        name: the phase name.
+
+    Returns:
+        a context manager.
+    """
+    if _current is None:
+        return nullcontext()
+
+    return _current.phase(name)
+
+
+def count(name: str, amount: int = 1):
+    """Add to a counter.
+
+    Arguments:
+        name: the counter name.
+        amount: the value to add.
+    """
+    if _current is not None:
+        _current.count(name, amount)
+
+
+def report() -> dict | None:
+    """Return the collected timings, or None if collection is off."""
+    if _current is None:
+        return None
+
+    return _current.report()
@@ -5,17 +5,61 @@ Functions:
         Calculate the size in bytes required to represent an integer in binary.
     block_walk(src, dest, block_size, func) -> None:
         Process the source data in blocks and write the result to destination.
+    worker_pool(workers: int):
+        Provide a pool of worker processes for a with block.
+    keep_worker_pools(keep: bool = True):
+        Keep the pools of worker_pool alive between with blocks.
+    parallel_block_walk(src, dest, block_size, func, workers) -> None:
+        Process the source data in blocks on a pool of worker processes.
+    readahead(src, chunk_size, depth=2):
+        Read the source in chunks on a background thread.
+    buffered_block_walk(src, dest, block_size, func, buffer_size) -> None:
+        Process the source data in blocks using large reads and writes.
+    mmap_block_walk(src, dest, block_size, func, buffer_size) -> None:
+        Process a memory-mapped source file in blocks without copying it.
+    random_padding(size: int) -> bytes:
+        Return random padding bytes, none of them 0x00 or 0x02.
     pad(msg: bytes, key_len: int) -> bytes:
         Apply padding to a message.
+    pad_into(buffer: bytearray, msg, key_len: int, padding=None)
+        -> bytearray:
+        Apply padding to a message inside a preallocated buffer.
     unpad(msg: bytes, key_len: int) -> tuple[bytes, int]:
         Remove padding from the message and return the unpadded message.
+    digest_key(secret: str, public_key: tuple[int, ...]) -> bytes:
+        Derive the key of the digests of the files stored under a key.
+    file_digest(path: str, key: bytes) -> bytes:
+        Return the keyed digest (HMAC-SHA256) of a file.
+    file_digests(path: str, key: bytes, chunk_size: int)
+        -> tuple[bytes, list[bytes]]:
+        Return the keyed digests of a file and of its chunks in one pass.
+    object_path(dir_path: str, key_id: int, digest: bytes) -> str:
+        Return where deduplicated content is stored.
+    temp_path(path: str) -> str:
+        Return a unique path to write a file to before moving it to path.
     base64_tuple(pair):
         Encode a pair of integers into base64 format as tuples.
 """
 
+import mmap
 import os
 import sys
 import base64
+import hashlib
+import hmac
+import queue
+import threading
+import scrypt.timing as timing
+from collections import deque
+from contextlib import contextmanager
+
+BATCH_BLOCKS = 256
+DEFAULT_BUFFER_SIZE = 1 << 22
+RANDOM_POOL_SIZE = 1 << 16
+OBJECTS_DIR = ".objects"
+
+_worker_pools = {}
+_keep_worker_pools = False
 
 
 def get_size_in_bytes(n: int) -> int:
@@ -37,14 +81,330 @@ def block_walk(src, dest, block_size, func) -> None:
         src: The source file or buffer to read data from.
         dest: The destination file or buffer to write processed data to.
         block_size: The size of each block of data to be read and processed.
-        func: The function to apply to each block of data.
+        func: The function mapping a list of blocks to the list of their
+            results.
     """
     while True:
-        block = src.read(block_size)
+        with timing.phase("io.read"):
+            block = src.read(block_size)
         if not block:
             return
 
-        dest.write(func(block))
+        with timing.phase("crypto"):
+            result = func([block])[0]
+        with timing.phase("io.write"):
+            dest.write(result)
+        _count(len(block), len(result), block_size)
+
+
+def _count(bytes_in: int, bytes_out: int, block_size: int):
+    """Update the timing counters after a chunk of blocks is processed.
+
+    Arguments:
+        bytes_in: The number of bytes read.
+        bytes_out: The number of bytes written.
+        block_size: The size of each block that was read.
+    """
+    timing.count("blocks", -(-bytes_in // block_size))
+    timing.count("bytes_in", bytes_in)
+    timing.count("bytes_out", bytes_out)
+
+
+def _process_batch(func, batch: bytes, block_size: int) -> bytes:
+    """Apply func to the blocks of a batch and join the results.
+
+    Arguments:
+        func: The function mapping a list of blocks to the list of their
+            results.
+        batch: Consecutive blocks read from the source.
+        block_size: The size of each block inside the batch.
+
+    Returns:
+        The concatenated results for the batch.
+    """
+    return b"".join(
+        func([
+            batch[i:i + block_size] for i in range(0, len(batch), block_size)
+        ])
+    )
+
+
+@contextmanager
+def worker_pool(workers: int):
+    """Provide a pool of worker processes for a with block.
+
+    The pool is shut down when the block exits, unless keep_worker_pools
+    was called; a kept pool is dropped if the block raises.
+
+    Arguments:
+        workers: The number of worker processes.
+
+    Yields:
+        A concurrent.futures.ProcessPoolExecutor.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    if not _keep_worker_pools:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            yield executor
+        return
+
+    executor = _worker_pools.get(workers)
+    if executor is None:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        _worker_pools[workers] = executor
+    try:
+        yield executor
+    except BaseException:
+        del _worker_pools[workers]
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+
+
+def keep_worker_pools(keep: bool = True):
+    """Keep the pools of worker_pool alive between with blocks.
+
+    Long-running processes use this to start the workers once.
+
+    Arguments:
+        keep: False shuts the kept pools down and stops keeping them.
+    """
+    global _keep_worker_pools
+    _keep_worker_pools = keep
+    if not keep:
+        for executor in _worker_pools.values():
+            executor.shutdown()
+        _worker_pools.clear()
+
+
+def parallel_block_walk(src, dest, block_size, func, workers) -> None:
+    """Process the source data in blocks on a pool of worker processes.
+
+    The source is split into batches of BATCH_BLOCKS blocks, which are
+    processed concurrently and written to the destination in order.
+    At most two batches per worker are in flight, so memory stays bounded.
+
+    Arguments:
+        src: The source file or buffer to read data from.
+        dest: The destination file or buffer to write processed data to.
+        block_size: The size of each block of data to be read and processed.
+        func: The function mapping a list of blocks to the list of their
+            results; it must be picklable (e.g. a module level function or
+            a functools.partial).
+        workers: The number of worker processes.
+    """
+    batch_size = block_size * BATCH_BLOCKS
+    pending = deque()
+
+    with worker_pool(workers) as executor:
+        while True:
+            with timing.phase("io.read"):
+                batch = src.read(batch_size)
+            if batch:
+                pending.append(
+                    executor.submit(_process_batch, func, batch, block_size)
+                )
+                _count(len(batch), 0, block_size)
+
+            if pending and (not batch or len(pending) >= 2 * workers):
+                with timing.phase("crypto"):
+                    result = pending.popleft().result()
+                with timing.phase("io.write"):
+                    dest.write(result)
+                timing.count("bytes_out", len(result))
+
+            if not batch and not pending:
+                return
+
+
+def readahead(src, chunk_size, depth=2):
+    """Read the source in chunks on a background thread.
+
+    At most depth chunks are buffered ahead of the consumer, so reading
+    overlaps with processing while memory stays bounded.
+
+    Arguments:
+        src: The source file or buffer to read data from.
+        chunk_size: The size of each chunk.
+        depth: The maximum number of chunks read ahead.
+
+    Yields:
+        The chunks of the source, in order.
+    """
+    chunks = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def reader():
+        try:
+            while not stop.is_set():
+                chunk = src.read(chunk_size)
+                chunks.put(chunk)
+                if not chunk:
+                    return
+        except Exception as e:
+            chunks.put(e)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        stop.set()
+        while thread.is_alive():
+            try:
+                chunks.get_nowait()
+            except queue.Empty:
+                thread.join(0.01)
+
+
+def buffered_block_walk(src, dest, block_size, func, buffer_size) -> None:
+    """Process the source data in blocks using large reads and writes.
+
+    The source is read ahead in chunks of about buffer_size bytes (rounded
+    down to whole blocks) and the results of every chunk are written with
+    a single call, so memory use does not depend on the file size.
+
+    Arguments:
+        src: The source file or buffer to read data from.
+        dest: The destination file or buffer to write processed data to.
+        block_size: The size of each block of data to be read and processed.
+        func: The function mapping a list of blocks to the list of their
+            results.
+        buffer_size: The approximate number of bytes read per chunk.
+    """
+    chunk_size = max(1, buffer_size // block_size) * block_size
+
+    chunks = readahead(src, chunk_size)
+    while True:
+        with timing.phase("io.read"):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+
+        with timing.phase("crypto"):
+            result = _process_batch(func, chunk, block_size)
+        with timing.phase("io.write"):
+            dest.write(result)
+        _count(len(chunk), len(result), block_size)
+
+    with timing.phase("io.write"):
+        dest.flush()
+
+
+def mmap_block_walk(src, dest, block_size, func, buffer_size) -> None:
+    """Process a memory-mapped source file in blocks without copying it.
+
+    func receives lists of memoryview slices of the mapping instead of
+    freshly allocated bytes, about buffer_size bytes at a time, and the
+    results of every list are written with a single call.
+
+    Arguments:
+        src: The source file to map; it must have a fileno.
+        dest: The destination file or buffer to write processed data to.
+        block_size: The size of each block of data to be processed.
+        func: The function mapping a list of blocks to the list of their
+            results.
+        buffer_size: The approximate number of bytes read per call of
+            func.
+    """
+    size = os.fstat(src.fileno()).st_size
+    if size == 0:
+        return
+
+    chunk_size = max(1, buffer_size // block_size) * block_size
+
+    with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        with memoryview(mapped) as view:
+            written = 0
+            for start in range(0, size, chunk_size):
+                end = min(start + chunk_size, size)
+                blocks = [
+                    view[i:i + block_size]
+                    for i in range(start, end, block_size)
+                ]
+                with timing.phase("crypto"):
+                    result = b"".join(func(blocks))
+                # the slices must be gone before the mapping is closed
+                for block in blocks:
+                    block.release()
+                del blocks
+
+                with timing.phase("io.write"):
+                    dest.write(result)
+                written += len(result)
+
+            with timing.phase("io.write"):
+                dest.flush()
+
+    _count(size, written, block_size)
+
+
+class _RandomPool:
+    """Random bytes other than 0x00 and 0x02, read in large chunks.
+
+    The separator must be the first 0x02 byte after the start marker, so
+    both values are deleted from every chunk with bytes.translate. The
+    remaining bytes stay uniformly distributed over the other 254 values.
+    """
+
+    def __init__(self):
+        """Create an empty pool."""
+        self.reset()
+
+    def reset(self):
+        """Drop the buffered bytes, e.g. in a forked child process."""
+        self.lock = threading.Lock()
+        self.chunk = b""
+        self.pos = 0
+
+    def take(self, size: int) -> bytes:
+        """Return size random bytes.
+
+        Arguments:
+            size: The number of bytes.
+
+        Returns:
+            The random bytes, never 0x00 or 0x02.
+        """
+        if size == 0:
+            return b""
+
+        parts = []
+        with self.lock:
+            while size > 0:
+                if self.pos >= len(self.chunk):
+                    chunk = os.urandom(max(RANDOM_POOL_SIZE, size))
+                    self.chunk = chunk.translate(None, b"\x00\x02")
+                    self.pos = 0
+
+                part = self.chunk[self.pos:self.pos + size]
+                self.pos += len(part)
+                size -= len(part)
+                parts.append(part)
+
+        return b"".join(parts)
+
+
+_random_pool = _RandomPool()
+os.register_at_fork(after_in_child=_random_pool.reset)
+
+
+def random_padding(size: int) -> bytes:
+    """Return random padding bytes, none of them 0x00 or 0x02.
+
+    Arguments:
+        size: The number of bytes.
+
+    Returns:
+        The padding.
+    """
+    return _random_pool.take(size)
 
 
 def pad(msg: bytes, key_len: int) -> bytes:
@@ -57,19 +417,35 @@ def pad(msg: bytes, key_len: int) -> bytes:
     Returns:
         The padded message.
     """
-    start = b"\x00\x01"
-    separator = b"\x02"
+    return bytes(pad_into(bytearray(key_len - 1), msg, key_len))
 
-    padding_size = key_len - 1 - len(msg) - 3
-    padding = bytearray(os.urandom(padding_size))
 
-    for i in range(len(padding)):
-        if padding[i] == 0:
-            padding[i] = os.urandom(1)[0]
+def pad_into(
+    buffer: bytearray, msg, key_len: int, padding=None
+) -> bytearray:
+    """Apply padding to a message inside a preallocated buffer.
+
+    Arguments:
+        buffer: A bytearray of key_len - 1 bytes, reused between calls.
+        msg: The message to be padded (any bytes-like object).
+        key_len: The length of the key in bytes.
+        padding: The key_len - 4 - len(msg) padding bytes (any bytes-like
+            object, e.g. a slice of one random_padding draw for many
+            messages), or None to draw them.
 
-    padded_message = start + padding + separator + msg
+    Returns:
+        The buffer, holding the padded message.
+    """
+    padding_size = key_len - 1 - len(msg) - 3
+    if padding is None:
+        padding = random_padding(padding_size)
 
-    return padded_message
+    buffer[0:2] = b"\x00\x01"
+    buffer[2:2 + padding_size] = padding
+    buffer[2 + padding_size] = 2
+    buffer[3 + padding_size:] = msg
+
+    return buffer
 
 
 def unpad(msg: bytes, key_len: int) -> tuple[bytes, int]:
@@ -86,6 +462,103 @@ def unpad(msg: bytes, key_len: int) -> tuple[bytes, int]:
     return msg[pos + 1:], (key_len - pos - 2)
 
 
+def digest_key(secret: str, public_key: tuple[int, ...]) -> bytes:
+    """Derive the key of the digests of the files stored under a key.
+
+    Digests are stored in the db and name deduplicated ciphertexts, so
+    they are keyed: without the secret, they don't tell whether someone
+    stored a given file.
+
+    Arguments:
+        secret: The digest secret from config.json.
+        public_key: The public key (e, n) the files are encrypted with.
+
+    Returns:
+        A 32 bytes key, different for every public key.
+    """
+    n = public_key[1]
+    return hmac.new(
+        secret.encode("utf-8"),
+        b"encdb-digest" + n.to_bytes(get_size_in_bytes(n), "little"),
+        hashlib.sha256,
+    ).digest()
+
+
+def file_digest(path: str, key: bytes) -> bytes:
+    """Return the keyed digest (HMAC-SHA256) of a file.
+
+    Arguments:
+        path: The path of the file.
+        key: The key returned by digest_key.
+
+    Returns:
+        The 32 bytes digest.
+    """
+    digest = hmac.new(key, digestmod=hashlib.sha256)
+    with open(path, "rb") as reader:
+        while chunk := reader.read(DEFAULT_BUFFER_SIZE):
+            digest.update(chunk)
+
+    return digest.digest()
+
+
+def file_digests(
+    path: str, key: bytes, chunk_size: int
+) -> tuple[bytes, list[bytes]]:
+    """Return the keyed digests of a file and of its chunks in one pass.
+
+    Arguments:
+        path: The path of the file.
+        key: The key returned by digest_key.
+        chunk_size: The size of the chunks; the last one may be shorter.
+
+    Returns:
+        The digest of the whole file, as file_digest returns it, and one
+        32 bytes digest per chunk, in order.
+    """
+    digest = hmac.new(key, digestmod=hashlib.sha256)
+    digests = []
+    read_size = max(1, DEFAULT_BUFFER_SIZE // chunk_size) * chunk_size
+    with open(path, "rb") as reader:
+        while data := reader.read(read_size):
+            digest.update(data)
+            with memoryview(data) as view:
+                for i in range(0, len(data), chunk_size):
+                    digests.append(
+                        hmac.digest(key, view[i:i + chunk_size], "sha256")
+                    )
+
+    return digest.digest(), digests
+
+
+def object_path(dir_path: str, key_id: int, digest: bytes) -> str:
+    """Return where deduplicated content is stored.
+
+    Ciphertexts depend on the key, so every key has its own directory.
+
+    Arguments:
+        dir_path: The directory of a user's encrypted files.
+        key_id: The id of the key the content is encrypted with.
+        digest: The digest of the plaintext.
+
+    Returns:
+        The path of the ciphertext, named after the digest.
+    """
+    return os.path.join(dir_path, OBJECTS_DIR, str(key_id), digest.hex())
+
+
+def temp_path(path: str) -> str:
+    """Return a unique path to write a file to before moving it to path.
+
+    Arguments:
+        path: The final path of the file.
+
+    Returns:
+        A path in the same directory, so os.replace doesn't copy.
+    """
+    return f"{path}.{os.getpid()}-{os.urandom(4).hex()}.tmp"
+
+
 def base64_tuple(pair):
     """Encode a pair of integers into base64 format as tuples.
 
@@ -0,0 +1,531 @@
+"""This module provides an asyncio API over the encrypted database.
+
+The RSA work runs on a pool of worker processes and the SQLite queries
+on a pool of threads, each with its own connection, so the event loop
+is never blocked. At most max_pending operations run at a time; the
+others wait for a slot, which keeps memory and queue lengths bounded.
+
+    async with Vault("encdb.db", "encrypted", "alice") as vault:
+        key_pair = await vault.generate_key(default=True)
+        await vault.encrypt("report.pdf")
+        data = await vault.read("report.pdf", key_pair[1])
+        async for file in vault.files():
+            print(file)
+
+Classes:
+    Vault: The encrypted files of one user.
+"""
+
+import asyncio
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import db.dbconn as db
+import scrypt.batch as batch
+import scrypt.compress as compress
+import scrypt.rsa as rsa
+import scrypt.utils as utils
+
+PAGE_SIZE = 256
+
+
+def _add_file(
+    filename: str,
+    path: str,
+    key_id: int,
+    user_id: int,
+    digest: bytes | None = None,
+    content_id: int | None = None,
+    output_path: str | None = None,
+) -> int:
+    """Insert a files record along with the reference to its ciphertext.
+
+    New deduplicated content is moved from output_path to path once it
+    is recorded, or dropped if another process recorded it first.
+
+    Arguments:
+        filename: The name the file is stored under.
+        path: The path of the ciphertext.
+        key_id: The id of the public key.
+        user_id: The id of the user.
+        digest: The digest of new deduplicated content, if any.
+        content_id: The contents record of reused content, if any.
+        output_path: Where new deduplicated content was encrypted to.
+
+    Returns:
+        The id of the new files record.
+    """
+    try:
+        with db.transaction():
+            if content_id is not None:
+                db.reference_content(content_id)
+            elif digest is not None:
+                _, path, created = db.add_content(key_id, digest, path)
+                if created:
+                    os.replace(output_path, path)
+            return db.add_file(filename, path, key_id, user_id)
+    finally:
+        if output_path is not None and os.path.exists(output_path):
+            os.remove(output_path)
+
+
+def _delete_file(user_id: int, filename: str, path: str) -> bool:
+    """Delete a files record and release its ciphertext.
+
+    Arguments:
+        user_id: The id of the user.
+        filename: The name the file is stored under.
+        path: The path of the ciphertext.
+
+    Returns:
+        True if the ciphertext isn't used anymore.
+    """
+    with db.transaction():
+        db.delete_file(user_id, filename)
+        return db.release_content(path)
+
+
+def _decrypt_bytes(
+    path: str,
+    private_key: tuple[int, ...],
+    buffer_size,
+    use_mmap: bool,
+    offset: int = 0,
+    length=None,
+) -> bytes:
+    """Decrypt a block or hybrid file, or a byte range of it, into memory.
+
+    Arguments:
+        path: The path to the encrypted file.
+        private_key: The private key (d, n) or (d, n, p, q, dp, dq, qinv).
+        buffer_size: The I/O buffer size for block files.
+        use_mmap: Whether to memory-map block files.
+        offset: The plaintext offset to start decrypting at.
+        length: The number of bytes to decrypt, or None for all of them.
+
+    Returns:
+        The plaintext.
+    """
+    output = io.BytesIO()
+    compress.decrypt_stream(
+        path,
+        output,
+        private_key,
+        buffer_size=buffer_size,
+        use_mmap=use_mmap,
+        offset=offset,
+        length=length,
+    )
+    return output.getvalue()
+
+
+class Vault:
+    """The encrypted files of one user.
+
+    Use it as an async context manager, or call open() and close().
+
+    Attributes:
+        username: The user the files belong to.
+        user_id: The id of the user, once the vault is open.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        encrypted_path: str,
+        username: str,
+        key_length: int = 2048,
+        file_format: str = "block",
+        workers: int | None = None,
+        db_threads: int = 4,
+        max_pending: int | None = None,
+        buffer_size: int | None = utils.DEFAULT_BUFFER_SIZE,
+        use_mmap: bool = False,
+        dedup: bool = True,
+        pragmas: dict | None = None,
+        executor=None,
+        compression: str | None = None,
+        compression_level: int | None = None,
+        digest_secret: str | None = None,
+    ):
+        """Configure a vault; no resources are used until open().
+
+        Arguments:
+            db_path: The path to the SQLite database.
+            encrypted_path: The directory of the encrypted files.
+            username: The user the files belong to.
+            key_length: The length of generated keys in bits.
+            file_format: "block" or "hybrid", for encrypt().
+            workers: The number of worker processes, None for one per CPU.
+            db_threads: The number of threads (and connections) for SQLite.
+            max_pending: The number of operations that may run at once,
+                None for twice the number of workers.
+            buffer_size: The I/O buffer size for block files.
+            use_mmap: Whether to memory-map block files.
+            dedup: Whether files with the same content under the same
+                key share one ciphertext; it needs digest_secret.
+            pragmas: SQLite settings applied over db.DEFAULT_PRAGMAS.
+            executor: A concurrent.futures executor for the RSA work,
+                used instead of a pool of worker processes; it isn't
+                shut down by close().
+            compression: "zlib", "lzma" or "zstd" to compress files
+                before encrypting them, or None.
+            compression_level: The compression level, None for the
+                default of the algorithm.
+            digest_secret: The secret the content digests are keyed
+                with, or None not to deduplicate.
+        """
+        self.username = username
+        self.user_id = None
+        self.db_path = db_path
+        self.encrypted_path = encrypted_path
+        self.key_length = key_length
+        self.file_format = file_format
+        self.buffer_size = buffer_size
+        self.use_mmap = use_mmap
+        self.dedup = dedup and digest_secret is not None
+        self.digest_secret = digest_secret
+        self.compression = compression
+        self.compression_level = compression_level
+
+        workers = workers or os.cpu_count() or 1
+        self._executor = executor
+        self._own_executor = executor is None
+        self._workers = workers
+        self._db_pool = db.ConnectionPool(db_path, db_threads, pragmas)
+        self._db_executor = None
+        self._db_threads = db_threads
+        self._slots = asyncio.Semaphore(max_pending or 2 * workers)
+        self._encrypting = set()
+        self._content_locks = {}
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def open(self):
+        """Start the executors and look up (or create) the user."""
+        from concurrent.futures import ProcessPoolExecutor
+
+        self._db_executor = ThreadPoolExecutor(self._db_threads)
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self._workers)
+
+        user = await self._db(db.get_user_by_username, self.username)
+        if user is None:
+            self.user_id = await self._db(db.add_user, self.username)
+        else:
+            self.user_id = user[0]
+
+    async def close(self):
+        """Wait for the executors to finish and close the connections."""
+        loop = asyncio.get_running_loop()
+        if self._own_executor and self._executor is not None:
+            await loop.run_in_executor(None, self._executor.shutdown)
+            self._executor = None
+        if self._db_executor is not None:
+            await loop.run_in_executor(None, self._db_executor.shutdown)
+            self._db_executor = None
+        self._db_pool.close()
+
+    def _query(self, func, *args, **kwargs):
+        """Run a db.dbconn helper on a pooled connection."""
+        with self._db_pool.connection():
+            return func(*args, **kwargs)
+
+    async def _db(self, func, *args, **kwargs):
+        """Run a db.dbconn helper on the SQLite threads."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._db_executor, partial(self._query, func, *args, **kwargs)
+        )
+
+    async def _crypto(self, func, *args):
+        """Run a picklable function on the RSA executor."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def _public_key(self, key_id: int | None):
+        """Return the id and the public key to encrypt with.
+
+        Arguments:
+            key_id: A key id, or None for the user's default key.
+
+        Raises:
+            LookupError: if the key doesn't exist.
+        """
+        if key_id is None:
+            key = await self._db(db.get_current_public_key, self.user_id)
+        else:
+            public_key = await self._db(db.get_public_key, key_id)
+            key = None if public_key is None else (key_id, public_key)
+        if key is None:
+            raise LookupError("provide a key id or set a default one")
+
+        return key
+
+    async def generate_key(
+        self, default: bool = False
+    ) -> tuple[tuple[int, int], tuple[int, ...]]:
+        """Generate a key pair and store its public key.
+
+        Arguments:
+            default: Whether it becomes the user's default key.
+
+        Returns:
+            The (public_key, private_key) pair; the private key isn't
+            stored anywhere.
+        """
+        async with self._slots:
+            key_pair = await self._crypto(rsa.key_gen, self.key_length)
+            e, n = key_pair[0]
+            key_id = await self._db(db.add_key, self.user_id, e, n)
+            if default:
+                await self._db(db.update_user, key_id, self.user_id)
+
+        return key_pair
+
+    async def set_default_key(self, key_id: int):
+        """Make a key the default key of the user.
+
+        Arguments:
+            key_id: The id of the key.
+
+        Raises:
+            LookupError: if the key doesn't exist.
+        """
+        if not await self._db(db.has_key, key_id):
+            raise LookupError(f"key {key_id} wasn't found in the db")
+        await self._db(db.update_user, key_id, self.user_id)
+
+    async def keys(self) -> list[tuple[int, int, bytes, bytes]]:
+        """Return the keys table records of the user."""
+        return await self._db(db.get_keys_by_user_id, self.user_id)
+
+    async def encrypt(
+        self,
+        path: str,
+        filename: str | None = None,
+        key_id: int | None = None,
+        file_format: str | None = None,
+    ) -> int:
+        """Encrypt a file and add it to the database.
+
+        Arguments:
+            path: The path of the file to be encrypted.
+            filename: The name it is stored under, by default its
+                basename; it may contain directories.
+            key_id: The public key to use, None for the default key.
+            file_format: "block" or "hybrid", None for the vault's.
+
+        Returns:
+            The id of the new files record.
+
+        Raises:
+            LookupError: if the key doesn't exist.
+            FileExistsError: if the name is already taken.
+        """
+        if filename is None:
+            filename = os.path.basename(path)
+
+        if filename in self._encrypting:
+            raise FileExistsError(f"{filename} is being encrypted")
+
+        self._encrypting.add(filename)
+        try:
+            async with self._slots:
+                key_id, key = await self._public_key(key_id)
+                dest = os.path.join(
+                    self.encrypted_path, self.username, filename
+                )
+                exists = await self._db(
+                    db.get_file_by_filename, self.user_id, filename
+                )
+                if exists is not None:
+                    raise FileExistsError(
+                        f"{filename} already exists in the db"
+                    )
+
+                file_format = file_format or self.file_format
+
+                async def encrypt(dest: str):
+                    await self._crypto(
+                        batch.encrypt_one,
+                        path,
+                        dest,
+                        key,
+                        file_format,
+                        self.buffer_size,
+                        self.use_mmap,
+                        self.compression,
+                        self.compression_level,
+                    )
+
+                if self.dedup:
+                    return await self._encrypt_content(
+                        path, filename, key_id, key, encrypt
+                    )
+
+                await encrypt(dest)
+                return await self._db(
+                    _add_file, filename, dest, key_id, self.user_id
+                )
+        finally:
+            self._encrypting.discard(filename)
+
+    async def _encrypt_content(
+        self, path, filename, key_id, key, encrypt
+    ) -> int:
+        """Store a file, reusing the ciphertext of identical content.
+
+        Requests for the same content under the same key are serialized,
+        so the ciphertext is written once by this vault. It is written
+        aside and only moved into place once it is recorded, so a
+        concurrent process storing the same content doesn't clobber it.
+
+        Arguments:
+            path: The path of the file to be encrypted.
+            filename: The name it is stored under.
+            key_id: The id of the public key.
+            key: The public key (e, n).
+            encrypt: A coroutine function encrypting the file to a path.
+
+        Returns:
+            The id of the new files record.
+        """
+        digest_key = utils.digest_key(self.digest_secret, key)
+        digest = await self._crypto(utils.file_digest, path, digest_key)
+        entry = self._content_locks.setdefault((key_id, digest), [None, 0])
+        if entry[0] is None:
+            entry[0] = asyncio.Lock()
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                content = await self._db(db.get_content, key_id, digest)
+                if content is not None:
+                    return await self._db(
+                        _add_file,
+                        filename,
+                        content[3],
+                        key_id,
+                        self.user_id,
+                        content_id=content[0],
+                    )
+
+                dest = utils.object_path(
+                    os.path.join(self.encrypted_path, self.username),
+                    key_id,
+                    digest,
+                )
+                output_path = utils.temp_path(dest)
+                await encrypt(output_path)
+                return await self._db(
+                    _add_file,
+                    filename,
+                    dest,
+                    key_id,
+                    self.user_id,
+                    digest=digest,
+                    output_path=output_path,
+                )
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._content_locks[(key_id, digest)]
+
+    async def read(
+        self,
+        filename: str,
+        private_key: tuple[int, ...],
+        output: str | None = None,
+        offset: int = 0,
+        length: int | None = None,
+    ) -> bytes | None:
+        """Decrypt a file of the user, or a byte range of it.
+
+        Only the blocks that cover the range are read and decrypted.
+
+        Arguments:
+            filename: The name the file is stored under.
+            private_key: The private key (d, n) or (d, n, p, q, dp, dq,
+                qinv).
+            output: A path to write the plaintext to, or None to return
+                it.
+            offset: The plaintext offset to start reading at.
+            length: The number of bytes to read, or None to read to the
+                end of the file.
+
+        Returns:
+            The plaintext, or None if it was written to output.
+
+        Raises:
+            FileNotFoundError: if there is no such file.
+        """
+        async with self._slots:
+            file = await self._db(
+                db.get_file_by_filename, self.user_id, filename
+            )
+            if file is None:
+                raise FileNotFoundError(f"{filename} not found")
+
+            if output is None:
+                return await self._crypto(
+                    _decrypt_bytes,
+                    file[2],
+                    private_key,
+                    self.buffer_size,
+                    self.use_mmap,
+                    offset,
+                    length,
+                )
+
+            await self._crypto(
+                batch.decrypt_one,
+                file[2],
+                output,
+                private_key,
+                self.buffer_size,
+                self.use_mmap,
+                offset,
+                length,
+            )
+
+    async def delete(self, filename: str):
+        """Delete a file and its database record.
+
+        Arguments:
+            filename: The name the file is stored under.
+
+        Raises:
+            FileNotFoundError: if there is no such file.
+        """
+        file = await self._db(db.get_file_by_filename, self.user_id, filename)
+        if file is None:
+            raise FileNotFoundError(f"{filename} not found")
+
+        unused = await self._db(_delete_file, self.user_id, filename, file[2])
+        if unused:
+            os.remove(file[2])
+
+    async def files(self):
+        """Iterate over the files records of the user.
+
+        The records are fetched PAGE_SIZE at a time.
+
+        Yields:
+            (id, filename, path, public_key_id, user_id) records.
+        """
+        after_id = 0
+        while True:
+            page = await self._db(
+                db.get_files_page, self.user_id, after_id, PAGE_SIZE
+            )
+            for file in page:
+                yield file
+            if len(page) < PAGE_SIZE:
+                return
+            after_id = page[-1][0]
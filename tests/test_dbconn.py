@@ -0,0 +1,105 @@
+"""Schema upgrade checks for db.dbconn.
+
+Databases created before the schema was versioned have a user_version
+of 0 and store public keys in base64. These tests build such a database
+and check that opening it upgrades the keys, so files encrypted with
+them can still be decrypted by their owner.
+"""
+
+import os
+import sqlite3
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import db.dbconn as db  # noqa: E402
+import scrypt.rsa as rsa  # noqa: E402
+import scrypt.utils as utils  # noqa: E402
+
+BASELINE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+  id INTEGER PRIMARY KEY,
+  username TEXT UNIQUE,
+  current_key_id INTEGER,
+  FOREIGN KEY (current_key_id) REFERENCES keys(id)
+);
+
+CREATE TABLE IF NOT EXISTS keys (
+  id INTEGER PRIMARY KEY,
+  user_id INTEGER,
+  e TEXT,
+  n TEXT,
+  FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS files (
+  id INTEGER PRIMARY KEY,
+  filename TEXT,
+  path TEXT,
+  public_key_id INTEGER,
+  user_id INTEGER,
+  FOREIGN KEY (public_key_id) REFERENCES keys(id) ON DELETE CASCADE,
+  FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+  UNIQUE (user_id, filename)
+);
+"""
+
+
+def _baseline_database(path: str, public_key: tuple[int, int]):
+    """Create a database the way encdb.py did before schema versioning.
+
+    Args:
+        path: path to the SQLite database file.
+        public_key: the default key (e, n) of the only user.
+    """
+    con = sqlite3.connect(path)
+    con.executescript(BASELINE_SCHEMA)
+    con.execute("INSERT INTO users (id, username) VALUES (1, 'tester')")
+    con.execute(
+        "INSERT INTO keys (id, user_id, e, n) VALUES (1, 1, ?, ?)",
+        utils.base64_tuple(public_key),
+    )
+    con.execute("UPDATE users SET current_key_id = 1 WHERE id = 1")
+    con.commit()
+    con.close()
+
+
+def test_baseline_database_round_trip(tmp_path):
+    public_key, private_key = rsa.key_gen(512)
+    path = str(tmp_path / "test.db")
+    _baseline_database(path, public_key)
+
+    data = os.urandom(5000)
+    src, enc, out = (tmp_path / name for name in ("src", "enc", "out"))
+    src.write_bytes(data)
+
+    db.connect(path)
+    try:
+        key_id, key = db.get_current_public_key(1)
+        rsa.encrypt_file(str(src), str(enc), key)
+
+        # key ids are never reused once the keys table is rebuilt
+        new_key_id = db.add_key(1, *public_key)
+        db.delete_key(new_key_id)
+        assert db.add_key(1, *public_key) > new_key_id
+    finally:
+        db.disconnect()
+
+    rsa.decrypt_file(str(enc), str(out), private_key)
+
+    assert (key_id, key) == (1, public_key)
+    assert out.read_bytes() == data
+
+
+def test_new_database_is_not_upgraded(tmp_path):
+    path = str(tmp_path / "test.db")
+
+    db.connect(path)
+    db.disconnect()
+
+    con = sqlite3.connect(path)
+    version = con.execute("PRAGMA user_version").fetchone()[0]
+    con.close()
+
+    assert version == db.SCHEMA_VERSION
@@ -0,0 +1,68 @@
+"""Startup checks for the command line tool.
+
+encdb.py is started for every command, so its import time matters. These
+tests run `python -X importtime encdb.py --help` and check the total
+import time against a budget, and that the modules of the heavy code
+paths are only imported by the commands that use them.
+
+The budget is IMPORT_BUDGET_MS, or the ENCDB_IMPORT_BUDGET_MS environment
+variable on slower machines.
+"""
+
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_BUDGET_MS = 250
+
+LAZY_MODULES = ("concurrent.futures", "gmpy2", "cProfile")
+
+
+def _import_times() -> list[tuple[str, int]]:
+    """Run encdb.py --help with -X importtime.
+
+    Returns:
+        A (name, cumulative microseconds) pair for every imported module,
+        in the order of the report. Nested imports keep the indentation
+        of their name.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "encdb.py", "--help"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    times = []
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if not line.startswith("import time:") or len(fields) != 3:
+            continue
+        if fields[1].strip().isdigit():
+            times.append((fields[2][1:], int(fields[1])))
+
+    return times
+
+
+def test_import_time_budget():
+    budget = float(os.environ.get("ENCDB_IMPORT_BUDGET_MS", IMPORT_BUDGET_MS))
+
+    # the best of a few runs, so a busy machine doesn't fail the test
+    total = min(
+        sum(us for name, us in _import_times() if not name.startswith(" "))
+        for _ in range(3)
+    )
+    total /= 1000
+
+    assert total <= budget, (
+        f"importing encdb takes {total:.1f} ms, over the {budget} ms budget"
+    )
+
+
+def test_heavy_modules_are_lazy():
+    imported = {name.strip() for name, _ in _import_times()}
+
+    assert not [name for name in LAZY_MODULES if name in imported]